@@ -44,6 +44,11 @@ export function useWebSocket() {
     ws.onmessage = (event) => {
       try {
         const message = JSON.parse(event.data) as WebSocketMessage;
+        // Answer the server heartbeat so this tab counts as alive
+        if (message.type === "ping") {
+          ws.send(JSON.stringify({ type: "pong" }));
+          return;
+        }
         setLastMessage(message);
       } catch (error) {
         console.error("Error parsing WebSocket message:", error);
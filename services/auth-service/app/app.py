@@ -8,6 +8,7 @@ from app.schemas import UserCreate, UserRead, UserUpdate
 from app.users import auth_backend, current_active_user, current_admin_user, fastapi_users
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from prometheus_fastapi_instrumentator import Instrumentator
@@ -17,6 +18,9 @@ app = FastAPI()
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app)
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="auth-service")
+
 app.include_router(
     fastapi_users.get_auth_router(auth_backend), prefix="/api/auth/jwt", tags=["auth"]
 )
@@ -145,6 +149,12 @@ async def on_startup():
         rabbitmq_client = create_rabbitmq_client("auth-service")
         await rabbitmq_client.connect()
         event_publisher = EventPublisher(rabbitmq_client)
+        # authenticated-route is hit on every page load: one login event per user per minute is enough
+        event_publisher.coalesce(
+            SystemEvents.USER_LOGIN,
+            window_ms=60000,
+            key=lambda data: data.get("user_id")
+        )
         
         # Configurar consumers para eventos que este servicio debe escuchar
         await rabbitmq_client.consume_events(
@@ -160,8 +170,11 @@ async def on_startup():
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    # Enviar eventos pendientes del buffer antes de desconectar
+    if event_publisher:
+        await event_publisher.close()
     # Desconectar de RabbitMQ
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
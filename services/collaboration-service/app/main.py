@@ -8,12 +8,16 @@ from app.db import get_db
 from app.schemas import ThreadCreate, ThreadOut, CommentCreate, CommentOut, UserMeta, oid_str
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 
 app = FastAPI(title="Collaboration Service", version="1.0.0")
 
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="collaboration-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
@@ -62,8 +66,11 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
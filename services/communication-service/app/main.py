@@ -3,9 +3,11 @@ from typing import List, Optional
 from prometheus_fastapi_instrumentator import Instrumentator
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 from datetime import datetime
 
 from app.auth import get_current_user, CurrentUser
+from app.presence import start_presence_client, close_presence_client, get_online_users
 from app.db import (
     get_user_chats,
     get_chat_by_id,
@@ -28,6 +30,9 @@ app = FastAPI(title="Communication Service")
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="communication-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
@@ -56,6 +61,8 @@ async def on_startup():
     """Connect to RabbitMQ on startup"""
     global rabbitmq_client, event_publisher
     
+    await start_presence_client()
+    
     # Connect to RabbitMQ (with error handling)
     try:
         rabbitmq_client = create_rabbitmq_client("communication-service")
@@ -72,14 +79,18 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    await close_presence_client()
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
 
-def chat_to_response(chat: dict, current_user_id: str) -> ChatResponse:
-    """Convert MongoDB chat document to ChatResponse"""
+def chat_to_response(chat: dict, current_user_id: str, online_users: Optional[dict] = None) -> ChatResponse:
+    """Convert MongoDB chat document to ChatResponse (online_users from get_online_users)"""
     # Get the other participant (for 1-on-1 chats)
     other_participant = None
     for participant in chat.get("participants", []):
@@ -104,7 +115,7 @@ def chat_to_response(chat: dict, current_user_id: str) -> ChatResponse:
         lastMessage=chat.get("last_message", ""),
         timestamp=chat.get("updated_at", datetime.utcnow()).isoformat(),
         unread=unread_count,
-        online=False,  # TODO: implement online status
+        online=bool(other_participant and (online_users or {}).get(other_participant)),
         userId=other_participant,
         participantIds=chat.get("participants", [])
     )
@@ -135,7 +146,14 @@ async def list_chats(
     """Get all chats for the current user"""
     chats, total = await get_user_chats(current_user.id, skip=skip, limit=limit)
     
-    chat_responses = [chat_to_response(chat, current_user.id) for chat in chats]
+    # One presence lookup for every chat in the page
+    online_users = await get_online_users(
+        participant
+        for chat in chats
+        for participant in chat.get("participants", [])
+        if participant != current_user.id
+    )
+    chat_responses = [chat_to_response(chat, current_user.id, online_users) for chat in chats]
     
     return chat_responses
 
@@ -185,7 +203,10 @@ async def get_chat(
             detail="You are not a participant in this chat"
         )
     
-    return chat_to_response(chat, current_user.id)
+    online_users = await get_online_users(
+        participant for participant in chat.get("participants", []) if participant != current_user.id
+    )
+    return chat_to_response(chat, current_user.id, online_users)
 
 
 @app.get("/api/communication/chats/{chat_id}/messages", response_model=List[MessageResponse])
@@ -267,6 +288,7 @@ async def send_message(
                 "chat_id": chat_id,
                 "message_id": message_id,
                 "sender_id": current_user.id,
+                "participants": chat.get("participants", []),
                 "text": message_data.text
             }
         )
@@ -0,0 +1,43 @@
+"""
+Consulta de presencia al WebSocket service (una sola llamada por lista de chats)
+"""
+import logging
+import os
+from typing import Dict, Iterable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_SERVICE_URL = os.getenv("WEBSOCKET_SERVICE_URL", "http://websocket-service:8000")
+PRESENCE_TIMEOUT = float(os.getenv("PRESENCE_TIMEOUT", "0.5"))
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def start_presence_client():
+    global _client
+    _client = httpx.AsyncClient(base_url=WEBSOCKET_SERVICE_URL, timeout=PRESENCE_TIMEOUT)
+
+
+async def close_presence_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_online_users(user_ids: Iterable[str]) -> Dict[str, bool]:
+    """Online status per user; everyone is reported offline if the lookup fails"""
+    user_ids = [user_id for user_id in set(user_ids) if user_id]
+    if not user_ids or _client is None:
+        return {}
+    try:
+        response = await _client.post("/presence", json={"user_ids": user_ids})
+        response.raise_for_status()
+        presence = response.json().get("presence", {})
+        return {user_id: bool(status.get("online")) for user_id, status in presence.items()}
+    except Exception as e:
+        # La lista de chats no debe fallar porque el WebSocket service no responda
+        logger.warning(f"Could not fetch presence: {e}")
+        return {}
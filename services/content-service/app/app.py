@@ -23,6 +23,7 @@ from app.schemas import (
 from typing import Literal
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 
 MaterialType = Literal[
     "Parcial de semestre anterior",
@@ -37,6 +38,9 @@ app = FastAPI(title="Content Service", version="1.0.0")
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="content-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
@@ -82,8 +86,11 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
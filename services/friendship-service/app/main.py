@@ -18,12 +18,16 @@ from app.schemas import (
 from app.auth import get_current_active_user, User
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 
 app = FastAPI(title="Friendship Service")
 
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="friendship-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
@@ -337,8 +341,11 @@ async def remove_friend(
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
@@ -3,13 +3,18 @@ from fastapi.responses import JSONResponse
 from prometheus_fastapi_instrumentator import Instrumentator
 from app.moderation import moderate_text
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
+from shared.dedup import DedupCache
 from shared.rabbitmq_config import SystemEvents
+from shared.tracing import TraceContextMiddleware
 
 app = FastAPI(title="Moderation Service", version="1.0.0")
 
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="moderation-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
@@ -38,7 +43,9 @@ async def on_startup():
                 "collaboration.thread_created",
                 "collaboration.comment_created"
             ],
-            handle_content_event
+            handle_content_event,
+            # Skip redelivered events so moderation scans are not repeated
+            dedup=DedupCache()
         )
         print("Moderation service connected to RabbitMQ")
     except Exception as e:
@@ -51,8 +58,11 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher
     
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
@@ -72,6 +82,7 @@ async def handle_content_event(event_type: str, event_data: dict):
             {
                 "original_event": event_type,
                 "content_id": data.get("material_id") or data.get("thread_id") or data.get("comment_id"),
+                "user_id": data.get("user_id") or data.get("created_by"),
                 "action": "auto_approved"
             }
         )
@@ -0,0 +1,253 @@
+"""
+Backplane entre nodos del WebSocket service sobre RabbitMQ
+Cada nodo (réplica o worker de uvicorn) tiene una queue exclusiva para las entregas
+dirigidas a sus conexiones y mantiene una copia del registro de qué nodo tiene qué
+usuario y qué sala. El registro se replica con anuncios en el propio exchange del
+backplane (altas/bajas, snapshot al arrancar, heartbeats para olvidar nodos caídos)
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Set, Tuple
+
+from aio_pika import DeliveryMode, ExchangeType, Message
+
+from shared.event_codec import decode_event, encode_event
+from event_routing import Recipients
+
+logger = logging.getLogger(__name__)
+
+BACKPLANE_EXCHANGE = "websocket.backplane"
+
+# Routing keys
+REGISTRY_KEY = "registry"
+ALL_NODES_KEY = "all"
+NODE_KEY_PREFIX = "node."
+
+KIND_USER = "user"
+KIND_ROOM = "room"
+
+
+def default_node_id() -> str:
+    """Node id unique per process (several uvicorn workers may share a host)"""
+    return os.getenv("WS_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Backplane:
+    """Cross-node delivery and user/room registry for the ConnectionManager"""
+
+    def __init__(self, rabbitmq_client, manager, node_id: Optional[str] = None, heartbeat_interval: float = 10.0):
+        self.client = rabbitmq_client
+        self.manager = manager
+        self.node_id = node_id or default_node_id()
+        self.heartbeat_interval = heartbeat_interval
+
+        # Registro replicado: usuario/sala -> nodos que lo tienen (sin incluir este nodo)
+        self.user_nodes: Dict[str, Set[str]] = {}
+        self.room_nodes: Dict[str, Set[str]] = {}
+        # Nodo -> (usuarios, salas) y último heartbeat visto
+        self.node_entries: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        self.node_last_seen: Dict[str, float] = {}
+
+        self._channel = None
+        self._exchange = None
+        self._queue = None
+        self._outbox: Deque[list] = deque()
+        self._outbox_ready = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def queue_name(self) -> str:
+        return f"websocket.node.{self.node_id}"
+
+    async def start(self):
+        """Declare the node queue, start consuming and announce this node"""
+        self._channel = await self.client.connection.channel()
+        await self._channel.set_qos(prefetch_count=100)
+        self._exchange = await self._channel.declare_exchange(
+            BACKPLANE_EXCHANGE, ExchangeType.TOPIC, durable=True
+        )
+        self._queue = await self._channel.declare_queue(self.queue_name, exclusive=True, auto_delete=True)
+        for routing_key in (NODE_KEY_PREFIX + self.node_id, REGISTRY_KEY, ALL_NODES_KEY):
+            await self._queue.bind(self._exchange, routing_key)
+
+        for coroutine in (self._consume(), self._flush_outbox(), self._heartbeat()):
+            self._tasks.add(asyncio.create_task(coroutine))
+
+        # Los demás nodos responden con su snapshot
+        await self._publish(REGISTRY_KEY, {"op": "hello"})
+        await self._publish(REGISTRY_KEY, self._snapshot())
+        logger.info(f"Backplane node {self.node_id} started")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        try:
+            await self._publish(REGISTRY_KEY, {"op": "leave"})
+            await self._channel.close()
+        except Exception as e:
+            logger.warning(f"Error cerrando el backplane: {e}")
+
+    # Registro local -> anuncios
+
+    def announce(self, kind: str, entity_id: str, present: bool):
+        """Queue a change of the users/rooms held by this node (sent in batches)"""
+        self._outbox.append([kind, entity_id, present])
+        self._outbox_ready.set()
+
+    async def _flush_outbox(self):
+        while True:
+            await self._outbox_ready.wait()
+            self._outbox_ready.clear()
+            changes = list(self._outbox)
+            self._outbox.clear()
+            try:
+                await self._publish(REGISTRY_KEY, {"op": "changes", "changes": changes})
+            except Exception as e:
+                logger.error(f"Error anunciando cambios del registro: {e}")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._publish(REGISTRY_KEY, {"op": "heartbeat"})
+            except Exception as e:
+                logger.error(f"Error enviando heartbeat del backplane: {e}")
+            self._expire_nodes()
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {
+            "op": "snapshot",
+            "users": list(self.manager.active_connections),
+            "rooms": list(self.manager.rooms),
+        }
+
+    # Entregas entre nodos
+
+    async def forward(
+        self,
+        message: str,
+        recipients: Recipients,
+        topic: Optional[str] = None,
+        coalesce_key: Optional[str] = None
+    ):
+        """Send a delivery to the other nodes holding any of its recipients"""
+        payload = {
+            "op": "deliver",
+            "message": message,
+            "users": list(recipients.users),
+            "rooms": list(recipients.rooms),
+            "broadcast": recipients.broadcast,
+            "public": recipients.public,
+            "topic": topic,
+            "coalesce_key": coalesce_key,
+        }
+        # Subscribers of public events can be on any node
+        if recipients.broadcast or (recipients.public and topic):
+            await self._publish(ALL_NODES_KEY, payload)
+            return
+
+        for node in self.nodes_for(recipients.users, recipients.rooms):
+            await self._publish(NODE_KEY_PREFIX + node, payload)
+
+    def nodes_for(self, user_ids: Iterable[str], room_ids: Iterable[str]) -> Set[str]:
+        """Other nodes holding any of the users or rooms"""
+        nodes: Set[str] = set()
+        for user_id in user_ids:
+            nodes.update(self.user_nodes.get(user_id, ()))
+        for room_id in room_ids:
+            nodes.update(self.room_nodes.get(room_id, ()))
+        return nodes
+
+    async def _publish(self, routing_key: str, payload: Dict[str, Any]):
+        payload["node"] = self.node_id
+        body, content_type = encode_event(payload)
+        await self._exchange.publish(
+            Message(body, content_type=content_type, delivery_mode=DeliveryMode.NOT_PERSISTENT),
+            routing_key=routing_key
+        )
+
+    # Mensajes recibidos
+
+    async def _consume(self):
+        async with self._queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                try:
+                    payload = decode_event(message.body, message.content_type)
+                    if payload.get("node") != self.node_id:
+                        await self._handle(payload)
+                except Exception as e:
+                    logger.error(f"Error procesando mensaje del backplane: {e}")
+                await message.ack()
+
+    async def _handle(self, payload: Dict[str, Any]):
+        op = payload.get("op")
+        node = payload["node"]
+
+        if op == "deliver":
+            recipients = Recipients(
+                users=tuple(payload.get("users") or ()),
+                rooms=tuple(payload.get("rooms") or ()),
+                broadcast=payload.get("broadcast", False),
+                public=payload.get("public", False),
+            )
+            self.manager.deliver_local(
+                payload["message"], recipients, payload.get("topic"), payload.get("coalesce_key")
+            )
+            return
+
+        self.node_last_seen[node] = time.monotonic()
+        if op == "changes":
+            for kind, entity_id, present in payload.get("changes", ()):
+                self._apply(node, kind, entity_id, present)
+        elif op == "snapshot":
+            self._forget_node(node)
+            for user_id in payload.get("users", ()):
+                self._apply(node, KIND_USER, user_id, True)
+            for room_id in payload.get("rooms", ()):
+                self._apply(node, KIND_ROOM, room_id, True)
+        elif op == "hello":
+            await self._publish(NODE_KEY_PREFIX + node, self._snapshot())
+        elif op == "leave":
+            self._forget_node(node)
+        elif op == "heartbeat" and node not in self.node_entries:
+            # Nodo desconocido (p. ej. se perdió su snapshot): pedirle el estado
+            self.node_entries[node] = (set(), set())
+            await self._publish(NODE_KEY_PREFIX + node, {"op": "hello"})
+
+    def _apply(self, node: str, kind: str, entity_id: str, present: bool):
+        users, rooms = self.node_entries.setdefault(node, (set(), set()))
+        entries, index = (users, self.user_nodes) if kind == KIND_USER else (rooms, self.room_nodes)
+        if present:
+            entries.add(entity_id)
+            index.setdefault(entity_id, set()).add(node)
+        else:
+            entries.discard(entity_id)
+            nodes = index.get(entity_id)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del index[entity_id]
+
+    def _forget_node(self, node: str):
+        users, rooms = self.node_entries.get(node, (set(), set()))
+        for user_id in list(users):
+            self._apply(node, KIND_USER, user_id, False)
+        for room_id in list(rooms):
+            self._apply(node, KIND_ROOM, room_id, False)
+        self.node_entries.pop(node, None)
+
+    def _expire_nodes(self):
+        """Forget nodes that missed three heartbeats"""
+        deadline = time.monotonic() - 3 * self.heartbeat_interval
+        for node, last_seen in list(self.node_last_seen.items()):
+            if last_seen < deadline:
+                logger.warning(f"Backplane node {node} expired")
+                del self.node_last_seen[node]
+                self._forget_node(node)
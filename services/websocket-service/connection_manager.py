@@ -0,0 +1,515 @@
+"""
+Gestor de conexiones WebSocket
+Mantiene índices usuario -> salas y sala -> conexiones para que join, leave y
+disconnect cuesten O(salas del usuario) y no O(salas totales).
+Cada conexión tiene una cola de salida acotada con su propia tarea writer: el
+fan-out sólo encola el frame ya serializado y un cliente lento no frena al resto.
+Un usuario puede tener varias conexiones (pestañas, dispositivos), cada una con su id.
+Con un backplane las entregas también llegan a las conexiones de otros nodos.
+Los clientes que lo piden reciben los frames pendientes agrupados en un array JSON
+(micro-batching: menos mensajes y syscalls en salas con mucha actividad).
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set
+from fastapi import WebSocket
+
+from event_routing import Recipients
+from inbound import TokenBucket
+from backplane import KIND_ROOM, KIND_USER
+from metrics import SEND_BATCH_FRAMES, SEND_QUEUE_FRAMES, SEND_QUEUE_FULL, SLOW_CONSUMER_EVICTIONS
+from replay import room_stream, user_stream
+from subscriptions import SubscriptionTrie
+
+logger = logging.getLogger(__name__)
+
+# Políticas cuando la cola de salida de una conexión está llena
+POLICY_DROP = "drop"              # se descarta el frame nuevo
+POLICY_COALESCE = "coalesce"      # reemplaza el frame pendiente con la misma clave, o descarta el más viejo
+POLICY_DISCONNECT = "disconnect"  # se cierra la conexión lenta
+
+# WebSocket close code "Try Again Later"
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Tópicos a los que puede suscribirse una conexión
+MAX_SUBSCRIPTIONS = 64
+
+
+class ClientConnection:
+    """A client socket with its bounded outbound queue drained by a writer task"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        max_queue: int,
+        policy: str,
+        on_failure: Callable[["ClientConnection"], None],
+        batch_window: float = 0.0,
+        batch_max: int = 50,
+        inbound_rate: float = 20.0,
+        inbound_burst: float = 40.0,
+        max_frame_size: int = 65536
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.connection_id = uuid.uuid4().hex
+        self.max_queue = max_queue
+        self.policy = policy
+        self._on_failure = on_failure
+        # Micro-batching (sólo clientes que aceptan frames array): espera y máximo por mensaje
+        self.batch_window = batch_window
+        self.batch_max = max(1, batch_max)
+        # Entradas [coalesce_key, frame]
+        self._queue: Deque[List] = deque()
+        # Entrada pendiente por clave de coalescing
+        self._keys: Dict[str, List] = {}
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+        # Topic patterns this connection subscribed to
+        self.topics: Set[str] = set()
+        # Streams already replayed to this connection (each one is replayed at most once)
+        self.resumed_streams: Set[str] = set()
+        # Last frame received from the client (time.monotonic)
+        self.last_activity = time.monotonic()
+        # Set on the first pong: only clients that answer pings are reaped when idle
+        self.answers_pings = False
+        # Inbound limits; trusted (authenticated services) connections get their own
+        self.inbound = TokenBucket(inbound_rate, inbound_burst)
+        self.max_frame_size = max_frame_size
+        self.trusted = False
+        self.closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        """Start the writer task"""
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def touch(self):
+        """Record activity from the client (any frame, including pongs)"""
+        self.last_activity = time.monotonic()
+
+    def trust(self, rate: float, burst: float, max_frame_size: int):
+        """Switch to the inbound limits of an authenticated service"""
+        self.trusted = True
+        self.inbound = TokenBucket(rate, burst)
+        self.max_frame_size = max_frame_size
+
+    def inbound_violation(self, frame: str) -> Optional[str]:
+        """Limit exceeded by a received frame ("size" or "rate"), None if it is allowed"""
+        if len(frame) > self.max_frame_size:
+            return "size"
+        if not self.inbound.take():
+            return "rate"
+        return None
+
+    def enqueue(self, frame: str, coalesce_key: Optional[str] = None) -> bool:
+        """Queue an already encoded frame, returns False if it was not queued"""
+        if self.closed:
+            return False
+
+        if len(self._queue) >= self.max_queue:
+            SEND_QUEUE_FULL.labels(self.policy).inc()
+            if self.policy == POLICY_DISCONNECT:
+                self._evict()
+                return False
+            if self.policy == POLICY_COALESCE:
+                entry = self._keys.get(coalesce_key) if coalesce_key is not None else None
+                if entry is not None:
+                    # El frame nuevo reemplaza al pendiente (sólo importa el último estado)
+                    entry[1] = frame
+                    return True
+                self._forget(self._queue.popleft())
+                SEND_QUEUE_FRAMES.dec()
+            else:
+                return False
+
+        entry = [coalesce_key, frame]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._keys[coalesce_key] = entry
+        SEND_QUEUE_FRAMES.inc()
+        self._ready.set()
+        return True
+
+    def close(self):
+        """Stop the writer and discard pending frames"""
+        if self.closed:
+            return
+        self.closed = True
+        SEND_QUEUE_FRAMES.dec(len(self._queue))
+        self._queue.clear()
+        self._keys.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                if self.batch_window > 0 and len(self._queue) < self.batch_max:
+                    # Los eventos que lleguen en la ventana salen en el mismo mensaje
+                    await asyncio.sleep(self.batch_window)
+                frames = []
+                while self._queue and len(frames) < self.batch_max:
+                    entry = self._queue.popleft()
+                    self._forget(entry)
+                    frames.append(entry[1])
+                if not frames:
+                    continue
+                SEND_QUEUE_FRAMES.dec(len(frames))
+                SEND_BATCH_FRAMES.observe(len(frames))
+                # Frames ya serializados: el array se arma sin volver a codificar
+                text = frames[0] if len(frames) == 1 else "[" + ",".join(frames) + "]"
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error enviando mensaje a {self.user_id}: {e}")
+            self._on_failure(self)
+
+    def _forget(self, entry: List):
+        key = entry[0]
+        if key is not None and self._keys.get(key) is entry:
+            del self._keys[key]
+
+    def _evict(self):
+        """Close a connection that cannot keep up"""
+        SLOW_CONSUMER_EVICTIONS.inc()
+        logger.warning(f"Conexión de {self.user_id} cerrada: cola de salida llena ({self.max_queue} frames)")
+        self._on_failure(self)
+        self.schedule_close(SLOW_CONSUMER_CLOSE_CODE)
+
+    def schedule_close(self, code: int):
+        """Close the socket in the background"""
+        task = asyncio.create_task(self._close_socket(code))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """Gestor de conexiones WebSocket"""
+
+    def __init__(
+        self,
+        max_queue: int = 256,
+        slow_consumer_policy: str = POLICY_DROP,
+        batch_window_ms: float = 5.0,
+        batch_max: int = 50,
+        inbound_rate: float = 20.0,
+        inbound_burst: float = 40.0,
+        max_frame_size: int = 65536,
+        service_inbound_rate: float = 500.0,
+        service_inbound_burst: float = 1000.0,
+        service_max_frame_size: int = 1024 * 1024
+    ):
+        if slow_consumer_policy not in (POLICY_DROP, POLICY_COALESCE, POLICY_DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.max_queue = max_queue
+        self.slow_consumer_policy = slow_consumer_policy
+        self.batch_window = batch_window_ms / 1000
+        self.batch_max = batch_max
+        self.inbound_rate = inbound_rate
+        self.inbound_burst = inbound_burst
+        self.max_frame_size = max_frame_size
+        self.service_inbound_rate = service_inbound_rate
+        self.service_inbound_burst = service_inbound_burst
+        self.service_max_frame_size = service_max_frame_size
+
+        # Active connections per user: user -> connection id -> connection
+        self.active_connections: Dict[str, Dict[str, ClientConnection]] = {}
+        # Active connections by id
+        self.connections: Dict[str, ClientConnection] = {}
+        # Chat/collaboration rooms: room -> users
+        self.rooms: Dict[str, Set[str]] = {}
+        # Reverse index: user -> rooms
+        self.user_rooms: Dict[str, Set[str]] = {}
+        # Connections per room (every device of every member)
+        self.room_connections: Dict[str, Set[ClientConnection]] = {}
+        # Topic subscriptions: pattern -> connections
+        self.subscriptions = SubscriptionTrie()
+        # Cross-node delivery and registry (None when running a single node)
+        self.backplane = None
+        # Online status tracking (PresenceTracker)
+        self.presence = None
+        # Sequence numbers and replay buffers per user/room (ReplayBuffers)
+        self.replay = None
+
+    @property
+    def connection_count(self) -> int:
+        return len(self.connections)
+
+    async def connect(
+        self, websocket: WebSocket, user_id: str, batching: bool = False, trusted: bool = False
+    ) -> ClientConnection:
+        """Accept new WebSocket connection (other devices of the user stay connected)
+        
+        batching: the client accepts array frames, pending frames are micro-batched
+        trusted: an authenticated service, subject to the service inbound limits
+        """
+        await websocket.accept()
+
+        connection = ClientConnection(
+            websocket, user_id, self.max_queue, self.slow_consumer_policy, self.disconnect,
+            batch_window=self.batch_window if batching else 0.0,
+            batch_max=self.batch_max if batching else 1,
+            inbound_rate=self.inbound_rate,
+            inbound_burst=self.inbound_burst,
+            max_frame_size=self.max_frame_size
+        )
+        if trusted:
+            self.trust(connection)
+        connection.start()
+
+        if user_id not in self.active_connections:
+            self._announce(KIND_USER, user_id, True)
+        if self.replay is not None:
+            self.replay.open(user_stream(user_id))
+        self.active_connections.setdefault(user_id, {})[connection.connection_id] = connection
+        self.connections[connection.connection_id] = connection
+
+        # Rooms the user already belongs to also deliver to the new device
+        for room_id in self.user_rooms.get(user_id, ()):
+            self.room_connections.setdefault(room_id, set()).add(connection)
+
+        logger.info(
+            f"User {user_id} connected ({connection.connection_id}). "
+            f"Total connections: {len(self.connections)}"
+        )
+        return connection
+
+    def disconnect(self, connection: ClientConnection):
+        """Remove a closed connection; the user leaves its rooms when it was their last one"""
+        if self.connections.pop(connection.connection_id, None) is None:
+            return
+        self._clear_subscriptions(connection)
+        connection.close()
+
+        user_id = connection.user_id
+        user_connections = self.active_connections.get(user_id)
+        if user_connections is not None:
+            user_connections.pop(connection.connection_id, None)
+        last_connection = not user_connections
+
+        if last_connection:
+            self.active_connections.pop(user_id, None)
+            self._announce(KIND_USER, user_id, False)
+            rooms = self.user_rooms.pop(user_id, set())
+        else:
+            rooms = self.user_rooms.get(user_id, set())
+
+        for room_id in rooms:
+            connections = self.room_connections.get(room_id)
+            if connections is not None:
+                connections.discard(connection)
+            if last_connection:
+                users = self.rooms.get(room_id)
+                if users is not None:
+                    users.discard(user_id)
+                self._drop_room_if_empty(room_id)
+
+        logger.info(
+            f"Usuario {user_id} desconectado ({connection.connection_id}). "
+            f"Total conexiones: {len(self.connections)}"
+        )
+
+    def trust(self, connection: ClientConnection):
+        """Apply the service inbound limits to a connection that authenticated as a service"""
+        if not connection.trusted:
+            connection.trust(self.service_inbound_rate, self.service_inbound_burst, self.service_max_frame_size)
+
+    def user_connections(self, user_id: str) -> Iterable[ClientConnection]:
+        """Every connection (device) of a user"""
+        return self.active_connections.get(user_id, {}).values()
+
+    async def send_personal_message(self, message: str, user_id: str, coalesce_key: Optional[str] = None):
+        """Enviar mensaje personal a todos los dispositivos de un usuario"""
+        await self.deliver(message, Recipients(users=(user_id,)), coalesce_key=coalesce_key)
+
+    async def send_room_message(self, message: str, room_id: str, coalesce_key: Optional[str] = None):
+        """Enviar mensaje a todos los usuarios de una sala"""
+        await self.deliver(message, Recipients(rooms=(room_id,)), coalesce_key=coalesce_key)
+
+    async def deliver(
+        self,
+        message: str,
+        recipients: Recipients,
+        topic: Optional[str] = None,
+        coalesce_key: Optional[str] = None
+    ):
+        """Deliver to the recipients on this node and, through the backplane, on the others"""
+        self.deliver_local(message, recipients, topic, coalesce_key)
+        if self.backplane is not None:
+            try:
+                await self.backplane.forward(message, recipients, topic, coalesce_key)
+            except Exception as e:
+                logger.error(f"Error reenviando mensaje por el backplane: {e}")
+
+    def deliver_local(
+        self,
+        message: str,
+        recipients: Recipients,
+        topic: Optional[str] = None,
+        coalesce_key: Optional[str] = None
+    ):
+        """Deliver to this node's connections: routed recipients plus, if public, topic subscribers"""
+        # Cada conexión recibe una sola copia, numerada en el primer stream que la alcanza
+        sent: Set[ClientConnection] = set()
+        for room_id in recipients.rooms:
+            self._deliver_stream(
+                room_stream(room_id), self.room_connections.get(room_id, ()), message, coalesce_key, sent
+            )
+        for user_id in recipients.users:
+            self._deliver_stream(user_stream(user_id), self.user_connections(user_id), message, coalesce_key, sent)
+
+        targets: Set[ClientConnection] = set()
+        if recipients.broadcast:
+            # Clients that chose their topics only receive what they subscribed to
+            targets.update(connection for connection in self.connections.values() if not connection.topics)
+        if recipients.public and topic:
+            targets.update(self.subscriptions.match(topic))
+        for connection in targets - sent:
+            connection.enqueue(message, coalesce_key)
+
+    def _deliver_stream(
+        self,
+        stream: str,
+        connections: Iterable[ClientConnection],
+        message: str,
+        coalesce_key: Optional[str],
+        sent: Set[ClientConnection]
+    ):
+        frame = message
+        if self.replay is not None and self.replay.has(stream):
+            frame = self.replay.append(stream, message)
+        for connection in connections:
+            if connection not in sent:
+                sent.add(connection)
+                connection.enqueue(frame, coalesce_key)
+
+    def resume(self, connection: ClientConnection, last_seqs: Dict[str, int], epoch: Optional[str]) -> Dict[str, Any]:
+        """Replay the frames a reconnecting client missed on its user and room streams
+        
+        Streams that cannot be replayed (other node or instance, frames already evicted,
+        not a stream of this user, already replayed to this connection, or more frames
+        than fit in the send queue) are reported as gaps for the client to refetch.
+        Replayed frames count against max_queue like any other frame.
+        """
+        allowed = {user_stream(connection.user_id)}
+        allowed.update(room_stream(room_id) for room_id in self.user_rooms.get(connection.user_id, ()))
+        # Sitio libre en la cola de envío, menos uno para la respuesta "resumed"
+        budget = connection.max_queue - connection.queue_depth - 1
+
+        replayed: Dict[str, int] = {}
+        gaps: List[str] = []
+        for stream, last_seq in last_seqs.items():
+            frames = None
+            if (
+                self.replay is not None and epoch == self.replay.epoch
+                and stream in allowed and stream not in connection.resumed_streams
+            ):
+                connection.resumed_streams.add(stream)
+                try:
+                    frames = self.replay.since(stream, int(last_seq))
+                except (TypeError, ValueError):
+                    frames = None
+            if frames is None or len(frames) > budget:
+                gaps.append(stream)
+                continue
+            budget -= len(frames)
+            for frame in frames:
+                connection.enqueue(frame)
+            replayed[stream] = len(frames)
+
+        return {
+            "type": "resumed",
+            "epoch": self.replay.epoch if self.replay is not None else None,
+            "replayed": replayed,
+            "gaps": gaps,
+        }
+
+    def subscribe(self, connection: ClientConnection, pattern: str):
+        """Subscribe a connection to a topic pattern (raises ValueError if invalid)"""
+        if pattern in connection.topics:
+            return
+        if len(connection.topics) >= MAX_SUBSCRIPTIONS:
+            raise ValueError(f"Too many subscriptions (max {MAX_SUBSCRIPTIONS})")
+        self.subscriptions.add(pattern, connection)
+        connection.topics.add(pattern)
+
+    def unsubscribe(self, connection: ClientConnection, pattern: str):
+        """Remove a topic subscription of a connection"""
+        if pattern in connection.topics:
+            connection.topics.discard(pattern)
+            self.subscriptions.remove(pattern, connection)
+
+    def _clear_subscriptions(self, connection: ClientConnection):
+        for pattern in connection.topics:
+            self.subscriptions.remove(pattern, connection)
+        connection.topics.clear()
+
+    def join_room(self, user_id: str, room_id: str):
+        """Join user (all of their devices) to a room"""
+        if room_id not in self.rooms:
+            self._announce(KIND_ROOM, room_id, True)
+        if self.replay is not None:
+            self.replay.open(room_stream(room_id))
+        self.rooms.setdefault(room_id, set()).add(user_id)
+        self.user_rooms.setdefault(user_id, set()).add(room_id)
+
+        connections = self.user_connections(user_id)
+        if connections:
+            self.room_connections.setdefault(room_id, set()).update(connections)
+
+        logger.info(f"User {user_id} joined room {room_id}")
+
+    def leave_room(self, user_id: str, room_id: str):
+        """Remove user from a room"""
+        users = self.rooms.get(room_id)
+        if not users or user_id not in users:
+            return
+
+        users.discard(user_id)
+        rooms = self.user_rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self.user_rooms[user_id]
+
+        # Remove the user's connections from room
+        connections = self.room_connections.get(room_id)
+        if connections is not None:
+            connections.difference_update(self.user_connections(user_id))
+
+        # If room is empty, delete it
+        self._drop_room_if_empty(room_id)
+
+        logger.info(f"User {user_id} left room {room_id}")
+
+    def _drop_room_if_empty(self, room_id: str):
+        if not self.rooms.get(room_id):
+            if self.rooms.pop(room_id, None) is not None:
+                self._announce(KIND_ROOM, room_id, False)
+            self.room_connections.pop(room_id, None)
+
+    def _announce(self, kind: str, entity_id: str, present: bool):
+        if self.backplane is not None:
+            self.backplane.announce(kind, entity_id, present)
+        if kind == KIND_USER and self.presence is not None:
+            self.presence.user_changed(entity_id, present)
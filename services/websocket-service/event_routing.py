@@ -0,0 +1,109 @@
+"""
+Tabla de ruteo de eventos RabbitMQ -> destinatarios WebSocket
+Cada tipo de evento sabe qué usuarios o salas deben recibirlo a partir de su payload;
+los eventos sin ruta no se reenvían a nadie (antes se difundían a todos los sockets).
+Los eventos públicos además llegan a los clientes suscritos a su tópico
+"""
+
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+
+class Recipients(NamedTuple):
+    """Users and rooms an event is delivered to"""
+    users: Tuple[str, ...] = ()
+    rooms: Tuple[str, ...] = ()
+    broadcast: bool = False
+    # Public events can also be received through topic subscriptions
+    public: bool = False
+
+
+BROADCAST = Recipients(broadcast=True, public=True)
+
+Route = Callable[[Dict[str, Any]], Recipients]
+
+
+def _values(data: Dict[str, Any], fields: Iterable[str]) -> Tuple[str, ...]:
+    values = []
+    for field in fields:
+        value = data.get(field)
+        if isinstance(value, (list, tuple, set)):
+            values.extend(str(item) for item in value if item)
+        elif value:
+            values.append(str(value))
+    return tuple(dict.fromkeys(values))
+
+
+def to_users(*fields: str) -> Route:
+    """Route to the user ids found in the given payload fields (scalars or lists)"""
+    return lambda data: Recipients(users=_values(data, fields))
+
+
+def to_rooms(*fields: str) -> Route:
+    """Route to the rooms named by the given payload fields"""
+    return lambda data: Recipients(rooms=_values(data, fields), public=True)
+
+
+def to_everyone(data: Dict[str, Any]) -> Recipients:
+    """Public events every connected client receives"""
+    return BROADCAST
+
+
+def to_subscribers(data: Dict[str, Any]) -> Recipients:
+    """Public events only delivered to the clients subscribed to their topic"""
+    return Recipients(public=True)
+
+
+ROUTES: Dict[str, Route] = {
+    # Auth: sólo el propio usuario (el payload trae su email)
+    "user.registered": to_users("user_id"),
+    "user.deleted": to_users("user_id"),
+
+    # Content: material público del feed
+    "content.created": to_everyone,
+
+    # Moderation: el autor del contenido moderado
+    "moderation.approved": to_users("user_id"),
+    "moderation.rejected": to_users("user_id"),
+
+    # Friendship: sólo las partes de la amistad
+    "friendship.request_sent": to_users("friend_id"),
+    "friendship.accepted": to_users("user_id", "friend_id"),
+    "friendship.blocked": to_users("blocked_by"),
+    "friendship.removed": to_users("user_id", "friend_id"),
+
+    # Collaboration: hilos nuevos son públicos, los comentarios van a la sala del hilo
+    "collaboration.thread_created": to_everyone,
+    "collaboration.comment_created": to_rooms("thread_id"),
+
+    # Communication: los participantes del chat
+    "communication.message_sent": to_users("participants"),
+
+    # Presence: quien se suscriba a "presence.<user_id>.changed" (o "presence.#")
+    "presence.changed": to_subscribers,
+}
+
+
+# Tópicos más específicos que el tipo de evento, para suscripciones como
+# "collaboration.thread.<thread_id>.*"
+TOPICS: Dict[str, Callable[[Dict[str, Any]], Optional[str]]] = {
+    "collaboration.comment_created": lambda data: (
+        f"collaboration.thread.{data['thread_id']}.comment_created" if data.get("thread_id") else None
+    ),
+    "presence.changed": lambda data: (
+        f"presence.{data['user_id']}.changed" if data.get("user_id") else None
+    ),
+}
+
+
+def event_topic(event_type: str, data: Dict[str, Any]) -> str:
+    """Subscription topic of an event (the event type unless a more specific topic is defined)"""
+    topic = TOPICS.get(event_type)
+    return (topic(data) if topic is not None else None) or event_type
+
+
+def resolve_recipients(event_type: str, data: Dict[str, Any]) -> Optional[Recipients]:
+    """Recipients of an event, or None when the event type has no route"""
+    route = ROUTES.get(event_type)
+    if route is None:
+        return None
+    return route(data)
@@ -0,0 +1,42 @@
+"""
+Límites de entrada por conexión WebSocket
+Token bucket de mensajes y tamaño máximo de frame, comprobados antes de parsear el JSON
+para que un cliente ruidoso no sature el event loop
+"""
+
+import time
+
+# WebSocket close codes
+POLICY_VIOLATION_CLOSE_CODE = 1008
+MESSAGE_TOO_BIG_CLOSE_CODE = 1009
+
+_WHITESPACE = " \t\r\n"
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def looks_like_object(frame: str) -> bool:
+    """Cheap check that a frame can be a JSON object, before the full parse"""
+    for char in frame:
+        if char not in _WHITESPACE:
+            return char == "{"
+    return False
@@ -0,0 +1,62 @@
+"""
+Introspección del WebSocket service (salas, conexiones y nodos)
+Páginas por cursor y agregados que no materializan la lista completa de salas o
+usuarios: con decenas de miles de usuarios serializarla bloqueaba el event loop
+"""
+
+import heapq
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sized, Tuple
+
+from backplane import default_node_id
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_TOP = 100
+
+
+def page_keys(keys: Iterable[str], cursor: Optional[str], limit: int) -> Tuple[List[str], Optional[str]]:
+    """
+    Keys after cursor in sorted order, and the cursor of the next page (None on the last one)
+
+    The cursor is the last key returned, so pages stay consistent while rooms and
+    users come and go; each page costs O(n log limit) instead of sorting everything
+    """
+    if cursor is not None:
+        keys = (key for key in keys if key > cursor)
+    page = heapq.nsmallest(limit + 1, keys)
+    if len(page) > limit:
+        page = page[:limit]
+        return page, page[-1]
+    return page, None
+
+
+def top_by_size(groups: Dict[str, Sized], n: int) -> List[Tuple[str, int]]:
+    """The n largest groups as (key, size), largest first"""
+    return [
+        (key, len(members))
+        for key, members in heapq.nlargest(n, groups.items(), key=lambda item: len(item[1]))
+    ]
+
+
+def node_summary(manager) -> Dict[str, Any]:
+    """Counts for this node and, with a backplane, for every peer it knows about"""
+    backplane = manager.backplane
+    summary: Dict[str, Any] = {
+        "node_id": backplane.node_id if backplane is not None else default_node_id(),
+        "connections": manager.connection_count,
+        "users": len(manager.active_connections),
+        "rooms": len(manager.rooms),
+        "peers": {}
+    }
+    if backplane is not None:
+        now = time.monotonic()
+        summary["peers"] = {
+            node: {
+                "users": len(users),
+                "rooms": len(rooms),
+                "last_seen_seconds_ago": round(now - backplane.node_last_seen.get(node, now), 1)
+            }
+            for node, (users, rooms) in backplane.node_entries.items()
+        }
+    return summary
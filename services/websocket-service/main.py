@@ -7,13 +7,28 @@ that can be used by other microservices
 import asyncio
 import json
 import logging
-from typing import Dict, List, Set
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import os
+from typing import Any, List, Optional
+from fastapi import FastAPI, Header, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from prometheus_fastapi_instrumentator import Instrumentator
 from shared.rabbitmq_client import create_rabbitmq_client, EventPublisher
 from shared.rabbitmq_config import SystemEvents
+from shared.dedup import DedupCache
+from shared.tracing import TraceContextMiddleware
+from shared.event_codec import dumps_json
+from connection_manager import ConnectionManager
+from event_routing import event_topic, resolve_recipients
+from backplane import Backplane
+from presence import PresenceTracker
+from replay import ReplayBuffers, user_stream
+from service_push import (
+    MAX_SERVICE_BATCH, SERVICE_FRAME_TYPES, SERVICE_TOKEN, handle_service_frame, is_authorized, push_many
+)
+from introspection import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_TOP, node_summary, page_keys, top_by_size
+from inbound import MESSAGE_TOO_BIG_CLOSE_CODE, POLICY_VIOLATION_CLOSE_CODE, looks_like_object
+from metrics import INBOUND_INVALID_FRAMES, INBOUND_LIMIT_DISCONNECTS
 import uvicorn
 
 # Configurar logging
@@ -25,9 +40,13 @@ app = FastAPI(title="WebSocket Service", version="1.0.0")
 # Initialize Prometheus metrics
 Instrumentator().instrument(app).expose(app, endpoint="/metrics")
 
+# Trace context for events published while handling a request
+app.add_middleware(TraceContextMiddleware, service_name="websocket-service")
+
 # RabbitMQ global client
 rabbitmq_client = None
 event_publisher = None
+backplane = None
 
 # CORS para permitir conexiones desde el frontend
 app.add_middleware(
@@ -45,118 +64,70 @@ class WebSocketMessage(BaseModel):
     user_id: str = None
     room_id: str = None
 
-class ConnectionManager:
-    """Gestor de conexiones WebSocket"""
-    
-    def __init__(self):
-        # Active connections per user
-        self.active_connections: Dict[str, WebSocket] = {}
-        # Chat/collaboration rooms
-        self.rooms: Dict[str, Set[str]] = {}
-        # Connections per room
-        self.room_connections: Dict[str, List[WebSocket]] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
-        """Accept new WebSocket connection"""
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected. Total connections: {len(self.active_connections)}")
-    
-    def disconnect(self, user_id: str):
-        """Disconnect user"""
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            
-            # Remove from all rooms
-            for room_id, users in self.rooms.items():
-                if user_id in users:
-                    users.remove(user_id)
-                    # Update room connections
-                    if room_id in self.room_connections:
-                        self.room_connections[room_id] = [
-                            ws for ws in self.room_connections[room_id] 
-                            if ws != self.active_connections.get(user_id)
-                        ]
-            
-            logger.info(f"Usuario {user_id} desconectado. Total conexiones: {len(self.active_connections)}")
-    
-    async def send_personal_message(self, message: str, user_id: str):
-        """Enviar mensaje personal a un usuario específico"""
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
-            try:
-                await websocket.send_text(message)
-            except Exception as e:
-                logger.error(f"Error enviando mensaje a {user_id}: {e}")
-                self.disconnect(user_id)
-    
-    async def send_room_message(self, message: str, room_id: str):
-        """Enviar mensaje a todos los usuarios de una sala"""
-        if room_id in self.room_connections:
-            disconnected_users = []
-            for websocket in self.room_connections[room_id]:
-                try:
-                    await websocket.send_text(message)
-                except Exception as e:
-                    logger.error(f"Error sending message to room {room_id}: {e}")
-                    # Mark for disconnection
-                    for user_id, ws in self.active_connections.items():
-                        if ws == websocket:
-                            disconnected_users.append(user_id)
-            
-            # Clean disconnected connections
-            for user_id in disconnected_users:
-                self.disconnect(user_id)
-    
-    def join_room(self, user_id: str, room_id: str):
-        """Join user to a room"""
-        if room_id not in self.rooms:
-            self.rooms[room_id] = set()
-            self.room_connections[room_id] = []
-        
-        self.rooms[room_id].add(user_id)
-        
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
-            if websocket not in self.room_connections[room_id]:
-                self.room_connections[room_id].append(websocket)
-        
-        logger.info(f"User {user_id} joined room {room_id}")
-    
-    def leave_room(self, user_id: str, room_id: str):
-        """Remove user from a room"""
-        if room_id in self.rooms and user_id in self.rooms[room_id]:
-            self.rooms[room_id].remove(user_id)
-            
-            # Remove WebSocket from room
-            if user_id in self.active_connections:
-                websocket = self.active_connections[user_id]
-                if room_id in self.room_connections:
-                    self.room_connections[room_id] = [
-                        ws for ws in self.room_connections[room_id] if ws != websocket
-                    ]
-            
-            # If room is empty, delete it
-            if not self.rooms[room_id]:
-                del self.rooms[room_id]
-                if room_id in self.room_connections:
-                    del self.room_connections[room_id]
-            
-            logger.info(f"User {user_id} left room {room_id}")
+class PresenceQuery(BaseModel):
+    user_ids: List[str] = Field(..., max_length=1000)
+
+class PushDelivery(BaseModel):
+    user_id: Optional[str] = None
+    room_id: Optional[str] = None
+    type: str = "notification"
+    data: Any = None
+
+class PushRequest(BaseModel):
+    service_id: Optional[str] = None
+    deliveries: List[PushDelivery] = Field(..., max_length=MAX_SERVICE_BATCH)
 
 # Global instance of connection manager
-manager = ConnectionManager()
+# (send queue per connection; policy for slow clients: drop | coalesce | disconnect)
+manager = ConnectionManager(
+    max_queue=int(os.getenv("WS_SEND_QUEUE_SIZE", "256")),
+    slow_consumer_policy=os.getenv("WS_SLOW_CONSUMER_POLICY", "drop"),
+    # Micro-batching window for clients connecting with ?batch=true
+    batch_window_ms=float(os.getenv("WS_BATCH_WINDOW_MS", "5")),
+    batch_max=int(os.getenv("WS_BATCH_MAX_FRAMES", "50")),
+    # Inbound limits per connection (messages/second, burst, characters per frame)
+    inbound_rate=float(os.getenv("WS_INBOUND_RATE", "20")),
+    inbound_burst=float(os.getenv("WS_INBOUND_BURST", "40")),
+    max_frame_size=int(os.getenv("WS_MAX_FRAME_SIZE", "65536")),
+    # Limits for connections authenticated with WS_SERVICE_TOKEN (pooled WebSocketClient)
+    service_inbound_rate=float(os.getenv("WS_SERVICE_INBOUND_RATE", "500")),
+    service_inbound_burst=float(os.getenv("WS_SERVICE_INBOUND_BURST", "1000")),
+    service_max_frame_size=int(os.getenv("WS_SERVICE_MAX_FRAME_SIZE", str(1024 * 1024)))
+)
+
+# Heartbeats, idle connection reaping and online status
+presence = PresenceTracker(
+    manager,
+    ping_interval=float(os.getenv("WS_PING_INTERVAL", "25")),
+    idle_timeout=float(os.getenv("WS_IDLE_TIMEOUT", "60")),
+    debounce=float(os.getenv("WS_PRESENCE_DEBOUNCE", "5"))
+)
+manager.presence = presence
+
+# Sequence numbers and replay of missed frames for reconnecting clients
+if os.getenv("WS_REPLAY_ENABLED", "true").lower() == "true":
+    manager.replay = ReplayBuffers(
+        max_frames=int(os.getenv("WS_REPLAY_FRAMES", "256")),
+        max_bytes=int(os.getenv("WS_REPLAY_MAX_BYTES", str(64 * 1024 * 1024))),
+        ttl_seconds=float(os.getenv("WS_REPLAY_TTL", "300"))
+    )
 
 @app.on_event("startup")
 async def on_startup():
     """Connect to RabbitMQ on startup and subscribe to all events"""
-    global rabbitmq_client, event_publisher
+    global rabbitmq_client, event_publisher, backplane
+    
+    if not SERVICE_TOKEN:
+        logger.warning("WS_SERVICE_TOKEN is not set: service frames and POST /internal/push will be rejected")
+    
+    presence.start()
     
     # Connect to RabbitMQ (with error handling)
     try:
         rabbitmq_client = create_rabbitmq_client("websocket-service")
         await rabbitmq_client.connect()
         event_publisher = EventPublisher(rabbitmq_client)
+        presence.publish = event_publisher.publish_event
         
         # Subscribe to ALL events to broadcast them via WebSocket
         await rabbitmq_client.consume_events(
@@ -166,46 +137,71 @@ async def on_startup():
                 SystemEvents.CONTENT_CREATED,
                 SystemEvents.MODERATION_APPROVED,
                 SystemEvents.MODERATION_REJECTED,
-                "friendship.request_sent",
-                "friendship.accepted",
-                "friendship.blocked",
-                "collaboration.thread_created",
-                "collaboration.comment_created",
-                "communication.message_sent"
+                "friendship.*",
+                "collaboration.*",
+                "communication.message_sent",
+                SystemEvents.PRESENCE_CHANGED
             ],
-            handle_rabbitmq_event
+            handle_rabbitmq_event,
+            # Keep per-chat ordering while other events are handled concurrently
+            ordering_key=lambda event: event.get("data", {}).get("chat_id"),
+            # Redeliveries after a reconnect must not be broadcast twice
+            dedup=DedupCache()
         )
         print("WebSocket service connected to RabbitMQ")
+        
+        # Backplane to run several nodes (replicas or uvicorn workers)
+        if os.getenv("WS_BACKPLANE", "false").lower() == "true":
+            backplane = Backplane(rabbitmq_client, manager)
+            await backplane.start()
+            manager.backplane = backplane
     except Exception as e:
         print(f"Warning: Could not connect to RabbitMQ: {e}")
         print("Service will continue without async events")
         rabbitmq_client = None
         event_publisher = None
+        backplane = None
+        manager.backplane = None
+        presence.publish = None
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     """Disconnect from RabbitMQ"""
-    global rabbitmq_client
+    global rabbitmq_client, event_publisher, backplane
     
+    await presence.stop()
+    if backplane:
+        manager.backplane = None
+        await backplane.stop()
+    # Flush buffered events before closing the connection
+    if event_publisher:
+        await event_publisher.close()
     if rabbitmq_client:
         await rabbitmq_client.disconnect()
 
 
 async def handle_rabbitmq_event(event_type: str, event_data: dict):
-    """Handle events from RabbitMQ and broadcast to WebSocket clients"""
+    """Handle events from RabbitMQ and deliver them to the WebSocket clients they concern"""
     logger.info(f"WebSocket Service received event: {event_type}")
     
-    # Broadcast event to all connected clients
-    message = json.dumps({
+    data = event_data.get('data', {})
+    if event_type == SystemEvents.PRESENCE_CHANGED:
+        presence.observe(data)
+    
+    recipients = resolve_recipients(event_type, data)
+    if recipients is None:
+        logger.debug(f"No route for event {event_type}, not forwarded")
+        return
+    
+    # Encoded once for every recipient
+    message = dumps_json({
         "type": event_type,
-        "data": event_data.get('data', {}),
+        "data": data,
         "timestamp": event_data.get('timestamp', '')
     })
     
-    # Broadcast to all active connections
-    for user_id in list(manager.active_connections.keys()):
-        await manager.send_personal_message(message, user_id)
+    await manager.deliver(message, recipients, event_topic(event_type, data))
 
 
 @app.get("/")
@@ -214,7 +210,7 @@ async def root():
     return {
         "service": "WebSocket Service",
         "status": "running",
-        "active_connections": len(manager.active_connections),
+        "active_connections": manager.connection_count,
         "active_rooms": len(manager.rooms)
     }
 
@@ -229,25 +225,91 @@ async def api_health_check():
     return {"status": "healthy"}
 
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    """Main WebSocket endpoint for real-time communication"""
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: str,
+    last_seq: Optional[int] = None,
+    epoch: Optional[str] = None,
+    batch: bool = False
+):
+    """Main WebSocket endpoint for real-time communication
+    
+    A reconnecting client passes ?last_seq=<seq>&epoch=<epoch> to get the frames
+    of its user stream it missed replayed. With ?batch=true the client accepts
+    JSON arrays of frames (events arriving within a few ms are sent together)
+    """
+    # Services authenticate in the handshake (X-Service-Token) to get their own limits from the first frame
+    connection = await manager.connect(
+        websocket, user_id, batching=batch, trusted=is_authorized(websocket.headers.get("x-service-token"))
+    )
+    # Tell the device which connection it is (a user may have several)
+    stream = user_stream(user_id)
+    connection.enqueue(dumps_json({
+        "type": "connected",
+        "connection_id": connection.connection_id,
+        "epoch": manager.replay.epoch if manager.replay else None,
+        "stream": stream,
+        "seq": manager.replay.current_seq(stream) if manager.replay else None
+    }))
+    if last_seq is not None:
+        connection.enqueue(dumps_json(manager.resume(connection, {stream: last_seq}, epoch)))
     
     try:
         while True:
             # Receive message from client
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            connection.touch()
+            
+            # Limits are checked before parsing anything
+            violation = connection.inbound_violation(data)
+            if violation:
+                logger.warning(f"Conexión {connection.connection_id} de {user_id} cerrada: límite de entrada ({violation})")
+                INBOUND_LIMIT_DISCONNECTS.labels(violation).inc()
+                manager.disconnect(connection)
+                await websocket.close(
+                    code=MESSAGE_TOO_BIG_CLOSE_CODE if violation == "size" else POLICY_VIOLATION_CLOSE_CODE
+                )
+                return
+            
+            message_data = None
+            if looks_like_object(data):
+                try:
+                    message_data = json.loads(data)
+                except ValueError:
+                    pass
+            if not isinstance(message_data, dict):
+                INBOUND_INVALID_FRAMES.inc()
+                connection.enqueue(dumps_json({"type": "error", "message": "Frames must be JSON objects"}))
+                continue
             
             # Process message based on type
             message_type = message_data.get("type")
             
-            if message_type == "join_room":
+            if message_type == "pong":
+                # Reply to the server heartbeat, activity already recorded
+                connection.answers_pings = True
+                continue
+            
+            elif message_type in SERVICE_FRAME_TYPES:
+                # Deliveries pushed by other microservices (shared.websocket_client);
+                # a valid token in the frame also switches the connection to the service limits
+                if not connection.trusted and is_authorized(message_data.get("token")):
+                    manager.trust(connection)
+                await handle_service_frame(manager, message_data)
+            
+            elif message_type == "resume":
+                # {"epoch": ..., "streams": {"room:<id>": last_seq, ...}} after re-joining rooms
+                streams = message_data.get("streams")
+                if isinstance(streams, dict):
+                    result = manager.resume(connection, streams, message_data.get("epoch"))
+                    connection.enqueue(dumps_json(result))
+            
+            elif message_type == "join_room":
                 room_id = message_data.get("room_id")
                 if room_id:
                     manager.join_room(user_id, room_id)
                     # Notify other users in the room
-                    join_message = json.dumps({
+                    join_message = dumps_json({
                         "type": "user_joined",
                         "user_id": user_id,
                         "room_id": room_id,
@@ -260,7 +322,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 if room_id:
                     manager.leave_room(user_id, room_id)
                     # Notificar a otros usuarios de la sala
-                    leave_message = json.dumps({
+                    leave_message = dumps_json({
                         "type": "user_left",
                         "user_id": user_id,
                         "room_id": room_id,
@@ -268,12 +330,35 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     })
                     await manager.send_room_message(leave_message, room_id)
             
+            elif message_type in ("subscribe", "unsubscribe"):
+                # Topic patterns such as "content.*" or "collaboration.thread.<id>.*"
+                topics = message_data.get("topics") or message_data.get("topic")
+                if isinstance(topics, str):
+                    topics = [topics]
+                if not isinstance(topics, list) or not topics or not all(isinstance(topic, str) for topic in topics):
+                    connection.enqueue(dumps_json({
+                        "type": "error",
+                        "message": "topics must be a topic string or a list of topic strings",
+                        "topics": sorted(connection.topics)
+                    }))
+                    continue
+                try:
+                    for topic in topics:
+                        if message_type == "subscribe":
+                            manager.subscribe(connection, topic)
+                        else:
+                            manager.unsubscribe(connection, topic)
+                    reply = {"type": "subscriptions", "topics": sorted(connection.topics)}
+                except ValueError as e:
+                    reply = {"type": "error", "message": str(e), "topics": sorted(connection.topics)}
+                connection.enqueue(dumps_json(reply))
+            
             elif message_type == "chat_message":
                 room_id = message_data.get("room_id")
                 message_text = message_data.get("message")
                 if room_id and message_text:
                     # Reenviar mensaje a todos los usuarios de la sala
-                    chat_message = json.dumps({
+                    chat_message = dumps_json({
                         "type": "chat_message",
                         "user_id": user_id,
                         "room_id": room_id,
@@ -287,7 +372,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 message_text = message_data.get("message")
                 if target_user and message_text:
                     # Enviar mensaje privado
-                    private_message = json.dumps({
+                    private_message = dumps_json({
                         "type": "private_message",
                         "from_user": user_id,
                         "message": message_text,
@@ -299,54 +384,132 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 # For collaboration updates (documents, etc.)
                 room_id = message_data.get("room_id")
                 if room_id:
-                    collaboration_message = json.dumps({
+                    collaboration_message = dumps_json({
                         "type": "collaboration_update",
                         "user_id": user_id,
                         "room_id": room_id,
                         "data": message_data.get("data"),
                         "timestamp": message_data.get("timestamp")
                     })
-                    await manager.send_room_message(collaboration_message, room_id)
+                    # Only the latest update per user and room matters to a slow client
+                    await manager.send_room_message(
+                        collaboration_message, room_id, coalesce_key=f"collab:{room_id}:{user_id}"
+                    )
             
             else:
                 # Generic message - forward to room if exists
                 room_id = message_data.get("room_id")
                 if room_id:
-                    await manager.send_room_message(data, room_id)
+                    await manager.send_room_message(dumps_json(message_data), room_id)
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        manager.disconnect(connection)
     except Exception as e:
         logger.error(f"Error en WebSocket para usuario {user_id}: {e}")
-        manager.disconnect(user_id)
+        manager.disconnect(connection)
 
 @app.get("/rooms")
-async def get_active_rooms():
-    """Get information about active rooms"""
+async def get_active_rooms(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Get information about active rooms, one page at a time (pass next_cursor back as cursor)
+    
+    Only member counts: a large room's members are listed by /rooms/{room_id}/users
+    """
+    room_ids, next_cursor = page_keys(manager.rooms, cursor, limit)
     return {
         "rooms": {
-            room_id: {
-                "user_count": len(users),
-                "users": list(users)
-            }
-            for room_id, users in manager.rooms.items()
+            room_id: {"user_count": len(manager.rooms[room_id])}
+            for room_id in room_ids
         },
-        "total_rooms": len(manager.rooms)
+        "total_rooms": len(manager.rooms),
+        "next_cursor": next_cursor
+    }
+
+@app.get("/rooms/{room_id}/users")
+async def get_room_users(
+    room_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Members of a room connected to this node, one page at a time"""
+    users = manager.rooms.get(room_id)
+    if users is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    user_ids, next_cursor = page_keys(users, cursor, limit)
+    return {
+        "room_id": room_id,
+        "user_count": len(users),
+        "users": user_ids,
+        "next_cursor": next_cursor
+    }
+
+@app.get("/rooms/summary")
+async def get_rooms_summary(top: int = Query(10, ge=0, le=MAX_TOP)):
+    """Room counts and the largest rooms, without listing members"""
+    return {
+        "total_rooms": len(manager.rooms),
+        "top_rooms": [
+            {"room_id": room_id, "user_count": user_count}
+            for room_id, user_count in top_by_size(manager.rooms, top)
+        ]
     }
 
+@app.post("/presence")
+async def get_presence(query: PresenceQuery):
+    """Batch presence lookup: online status and last_seen (epoch seconds) per user"""
+    return {"presence": presence.lookup(query.user_ids)}
+
+@app.post("/internal/push")
+async def internal_push(request: PushRequest, x_service_token: Optional[str] = Header(None)):
+    """Bulk delivery from backend services: many (user | room, payload) items per call"""
+    if not is_authorized(x_service_token):
+        raise HTTPException(status_code=401, detail="Invalid service token")
+    
+    delivered = await push_many(
+        manager,
+        (
+            {
+                "target_user": delivery.user_id,
+                "room_id": delivery.room_id,
+                "message_type": delivery.type,
+                "data": delivery.data
+            }
+            for delivery in request.deliveries
+        ),
+        request.service_id
+    )
+    return {"accepted": len(request.deliveries), "delivered": delivered}
+
 @app.get("/connections")
-async def get_active_connections():
-    """Get information about active connections"""
+async def get_active_connections(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Get information about active connections, one page of user IDs at a time"""
+    user_ids, next_cursor = page_keys(manager.active_connections, cursor, limit)
     return {
-        "active_connections": len(manager.active_connections),
-        "connected_users": list(manager.active_connections.keys())
+        "active_connections": manager.connection_count,
+        "active_users": len(manager.active_connections),
+        "connected_users": user_ids,
+        "next_cursor": next_cursor
     }
 
+@app.get("/connections/summary")
+async def get_connections_summary():
+    """Counts only, for this node and the backplane peers it knows about"""
+    return node_summary(manager)
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
         reload=True,
-        log_level="info"
+        log_level="info",
+        # Protocol-level cap, the per-connection WS_MAX_FRAME_SIZE check is stricter
+        ws_max_size=1024 * 1024,
+        # Negotiate permessage-deflate with clients that support it
+        ws_per_message_deflate=True
     )
@@ -0,0 +1,34 @@
+"""
+Métricas Prometheus propias del WebSocket service
+(el registry por defecto es el que expone Instrumentator en /metrics)
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+SEND_QUEUE_FRAMES = Gauge(
+    "websocket_send_queue_frames",
+    "Frames waiting in per-connection send queues (all connections)"
+)
+SEND_QUEUE_FULL = Counter(
+    "websocket_send_queue_full_total",
+    "Frames that found the connection send queue full, by slow consumer policy",
+    ["policy"]
+)
+SLOW_CONSUMER_EVICTIONS = Counter(
+    "websocket_slow_consumer_evictions_total",
+    "Connections closed because their send queue stayed full"
+)
+SEND_BATCH_FRAMES = Histogram(
+    "websocket_send_batch_frames",
+    "Frames written per WebSocket message (more than one when micro-batching)",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+INBOUND_LIMIT_DISCONNECTS = Counter(
+    "websocket_inbound_limit_disconnects_total",
+    "Connections closed for exceeding the inbound message rate or frame size",
+    ["reason"]
+)
+INBOUND_INVALID_FRAMES = Counter(
+    "websocket_inbound_invalid_frames_total",
+    "Client frames ignored because they are not a JSON object"
+)
@@ -0,0 +1,152 @@
+"""
+Presencia de usuarios del WebSocket service
+Heartbeats ping/pong iniciados por el servidor, cierre de conexiones inactivas,
+mapa usuario -> last_seen y eventos presence.changed con debounce (una recarga de
+pestaña no genera un offline/online)
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from shared.rabbitmq_config import SystemEvents
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code "Going Away"
+IDLE_CLOSE_CODE = 1001
+
+
+class PresenceTracker:
+    """Heartbeats, idle reaping and online status of the users of a ConnectionManager"""
+
+    def __init__(
+        self,
+        manager,
+        ping_interval: float = 25.0,
+        idle_timeout: float = 60.0,
+        debounce: float = 5.0,
+        max_users: int = 100000
+    ):
+        self.manager = manager
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.debounce = debounce
+        self.max_users = max_users
+        # Publishes presence.changed (EventPublisher.publish_event), None without RabbitMQ
+        self.publish: Optional[Callable[[str, Dict[str, Any]], Awaitable[None]]] = None
+
+        # Usuario -> epoch de la última vez que se lo vio conectado
+        self.last_seen: "OrderedDict[str, float]" = OrderedDict()
+        # Usuarios anunciados como online en el último presence.changed
+        self._announced_online: Set[str] = set()
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # Estado
+
+    def is_online(self, user_id: str) -> bool:
+        """Connected to this node or, with a backplane, to any other node"""
+        if user_id in self.manager.active_connections:
+            return True
+        backplane = self.manager.backplane
+        return backplane is not None and bool(backplane.user_nodes.get(user_id))
+
+    def lookup(self, user_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Batch presence: user -> {online, last_seen}"""
+        now = time.time()
+        result = {}
+        for user_id in user_ids:
+            online = self.is_online(user_id)
+            last_seen = now if online else self.last_seen.get(user_id)
+            result[user_id] = {"online": online, "last_seen": last_seen}
+        return result
+
+    def user_changed(self, user_id: str, online: bool):
+        """Called by the manager when a user gets their first or loses their last connection here"""
+        self._touch(user_id, time.time())
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[user_id] = asyncio.get_running_loop().call_later(self.debounce, self._emit, user_id)
+
+    def observe(self, data: Dict[str, Any]):
+        """Update last_seen from a presence.changed event (possibly from another node)"""
+        user_id = data.get("user_id")
+        last_seen = data.get("last_seen")
+        if user_id and last_seen and last_seen > self.last_seen.get(user_id, 0):
+            self._touch(user_id, last_seen)
+
+    def _touch(self, user_id: str, seen_at: float):
+        self.last_seen[user_id] = seen_at
+        self.last_seen.move_to_end(user_id)
+        while len(self.last_seen) > self.max_users:
+            self.last_seen.popitem(last=False)
+
+    def _emit(self, user_id: str):
+        self._timers.pop(user_id, None)
+        online = self.is_online(user_id)
+        if online == (user_id in self._announced_online):
+            # Volvió al estado anunciado dentro de la ventana de debounce
+            return
+        if online:
+            self._announced_online.add(user_id)
+        else:
+            self._announced_online.discard(user_id)
+
+        if self.publish is None:
+            return
+        task = asyncio.create_task(self._publish_change(user_id, online))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish_change(self, user_id: str, online: bool):
+        try:
+            await self.publish(SystemEvents.PRESENCE_CHANGED, {
+                "user_id": user_id,
+                "online": online,
+                "last_seen": self.last_seen.get(user_id, time.time())
+            })
+        except Exception as e:
+            logger.error(f"Error publicando presencia de {user_id}: {e}")
+
+    # Heartbeats
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                self._ping_and_reap()
+            except Exception as e:
+                logger.error(f"Error en el heartbeat de conexiones: {e}")
+
+    def _ping_and_reap(self):
+        now = time.monotonic()
+        # El mismo frame para todas las conexiones
+        ping = json.dumps({"type": "ping", "ts": time.time()})
+        for connection in list(self.manager.connections.values()):
+            # Clientes que nunca respondieron un ping (sólo escuchan) no se cierran por inactividad;
+            # la conexión caída la detecta el ping/pong del protocolo (uvicorn --ws-ping-interval, 20 s por defecto)
+            if connection.answers_pings and now - connection.last_activity > self.idle_timeout:
+                logger.info(f"Conexión {connection.connection_id} de {connection.user_id} inactiva, cerrando")
+                connection.schedule_close(IDLE_CLOSE_CODE)
+                self.manager.disconnect(connection)
+            else:
+                connection.enqueue(ping)
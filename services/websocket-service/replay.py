@@ -0,0 +1,132 @@
+"""
+Buffers de replay para clientes que se reconectan
+Cada usuario y cada sala es un stream con número de secuencia creciente; los frames
+recientes se guardan en un ring buffer (acotado en frames, en memoria total y por TTL)
+y un cliente que vuelve con su último seq recibe sólo lo que se perdió.
+Los buffers son locales al nodo: el epoch identifica la instancia que numeró los frames
+"""
+
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+
+def user_stream(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def room_stream(room_id: str) -> str:
+    return f"room:{room_id}"
+
+
+def add_sequence(frame: str, stream: str, seq: int) -> str:
+    """Add seq and stream to an encoded JSON object frame without decoding it"""
+    body = frame[1:].lstrip()
+    separator = "" if body.startswith("}") else ","
+    stream_json = stream.replace("\\", "\\\\").replace('"', '\\"')
+    return f'{{"seq":{seq},"stream":"{stream_json}"{separator}{body}'
+
+
+class _Stream:
+    __slots__ = ("seq", "frames", "touched_at")
+
+    def __init__(self, now: float):
+        self.seq = 0
+        # (seq, stored_at, frame)
+        self.frames: Deque[Tuple[int, float, str]] = deque()
+        self.touched_at = now
+
+
+class ReplayBuffers:
+    """Sequence counters and ring buffers of recent frames per stream"""
+
+    def __init__(self, max_frames: int = 256, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 300.0):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.epoch = uuid.uuid4().hex[:12]
+        self.total_bytes = 0
+        # Orden LRU: el stream tocado hace más tiempo primero
+        self._streams: "OrderedDict[str, _Stream]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def has(self, stream: str) -> bool:
+        return stream in self._streams
+
+    def current_seq(self, stream: str) -> int:
+        state = self._streams.get(stream)
+        return state.seq if state is not None else 0
+
+    def open(self, stream: str):
+        """Start buffering a stream (a local connection or room member wants it)"""
+        now = time.monotonic()
+        state = self._streams.get(stream)
+        if state is None:
+            self._streams[stream] = _Stream(now)
+        else:
+            state.touched_at = now
+            self._streams.move_to_end(stream)
+
+    def append(self, stream: str, frame: str) -> str:
+        """Number a frame in an open stream and keep it, returns the sequenced frame"""
+        now = time.monotonic()
+        state = self._streams.get(stream)
+        if state is None:
+            state = self._streams[stream] = _Stream(now)
+        state.seq += 1
+        sequenced = add_sequence(frame, stream, state.seq)
+        state.frames.append((state.seq, now, sequenced))
+        state.touched_at = now
+        self._streams.move_to_end(stream)
+        self.total_bytes += len(sequenced)
+
+        if len(state.frames) > self.max_frames:
+            self._pop_oldest(state)
+        self._purge(now)
+        return sequenced
+
+    def since(self, stream: str, last_seq: int) -> Optional[List[str]]:
+        """Frames after last_seq, or None if some of them are no longer buffered (a gap)"""
+        state = self._streams.get(stream)
+        if state is None:
+            return [] if last_seq == 0 else None
+        self._expire(state, time.monotonic())
+        if last_seq > state.seq:
+            # Numeración de otra vida del stream
+            return None
+        if last_seq == state.seq:
+            return []
+        first_seq = state.frames[0][0] if state.frames else state.seq + 1
+        if last_seq + 1 < first_seq:
+            return None
+        return [frame for seq, _, frame in state.frames if seq > last_seq]
+
+    def _pop_oldest(self, state: _Stream):
+        _, _, frame = state.frames.popleft()
+        self.total_bytes -= len(frame)
+
+    def _expire(self, state: _Stream, now: float):
+        deadline = now - self.ttl
+        while state.frames and state.frames[0][1] < deadline:
+            self._pop_oldest(state)
+
+    def _purge(self, now: float):
+        """Drop expired frames and idle streams (oldest first), then enforce the memory cap"""
+        deadline = now - self.ttl
+        while self._streams:
+            stream, state = next(iter(self._streams.items()))
+            if state.touched_at >= deadline:
+                break
+            self._expire(state, now)
+            if state.frames:
+                break
+            del self._streams[stream]
+
+        for state in list(self._streams.values()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            while state.frames and self.total_bytes > self.max_bytes:
+                self._pop_oldest(state)
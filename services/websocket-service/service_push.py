@@ -0,0 +1,83 @@
+"""
+Entregas iniciadas por otros microservicios
+Frames service_message / service_room_message / service_batch que envía
+shared.websocket_client.WebSocketClient y el endpoint POST /internal/push
+"""
+
+import hmac
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from shared.event_codec import dumps_json
+
+logger = logging.getLogger(__name__)
+
+# Los servicios deben presentarlo para poder enviar mensajes; sin él, nadie puede
+SERVICE_TOKEN = os.getenv("WS_SERVICE_TOKEN")
+
+SERVICE_FRAME_TYPES = ("service_message", "service_room_message", "service_batch")
+
+# Entregas por service_batch o por POST /internal/push
+MAX_SERVICE_BATCH = 1000
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """Fails closed: nothing is authorized while WS_SERVICE_TOKEN is unset"""
+    if not SERVICE_TOKEN or not isinstance(token, str):
+        return False
+    # Comparando bytes: compare_digest rechaza str con caracteres no ASCII (TypeError)
+    return hmac.compare_digest(token.encode(), SERVICE_TOKEN.encode())
+
+
+def build_frame(message_type: str, data: Any, service_id: Optional[str]) -> str:
+    """Frame a client receives for a service delivery"""
+    return dumps_json({
+        "type": message_type or "notification",
+        "data": data,
+        "from_service": service_id,
+        "timestamp": time.time()
+    })
+
+
+async def push(manager, delivery: Dict[str, Any], service_id: Optional[str]) -> bool:
+    """Deliver one {target_user | room_id, message_type, data} item, False if it has no target"""
+    frame = build_frame(delivery.get("message_type"), delivery.get("data"), service_id)
+    target_user = delivery.get("target_user")
+    room_id = delivery.get("room_id")
+    if target_user:
+        await manager.send_personal_message(frame, target_user)
+    elif room_id:
+        await manager.send_room_message(frame, room_id)
+    else:
+        return False
+    return True
+
+
+async def push_many(manager, deliveries: Iterable[Dict[str, Any]], service_id: Optional[str]) -> int:
+    """Deliver a batch, returns how many items had a target"""
+    delivered = 0
+    for delivery in deliveries:
+        if await push(manager, delivery, service_id):
+            delivered += 1
+    return delivered
+
+
+async def handle_service_frame(manager, message_data: Dict[str, Any]) -> int:
+    """Handle a service frame received on a WebSocket, returns the deliveries made"""
+    if not is_authorized(message_data.get("token")):
+        logger.warning(f"Service frame rejected from {message_data.get('service_id')}: invalid token")
+        return 0
+
+    service_id = message_data.get("service_id")
+    if message_data["type"] == "service_batch":
+        messages = message_data.get("messages") or ()
+        if not isinstance(messages, list) or len(messages) > MAX_SERVICE_BATCH:
+            logger.warning(f"Service batch rejected from {service_id}: not a list of at most {MAX_SERVICE_BATCH} messages")
+            return 0
+        return await push_many(manager, (message for message in messages if isinstance(message, dict)), service_id)
+    if message_data["type"] == "service_room_message":
+        # Frames de sala no llevan target_user
+        message_data = {key: value for key, value in message_data.items() if key != "target_user"}
+    return int(await push(manager, message_data, service_id))
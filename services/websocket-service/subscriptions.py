@@ -0,0 +1,84 @@
+"""
+Suscripciones de clientes a tópicos de eventos
+Los patrones usan la sintaxis de topic de RabbitMQ ('*' = una palabra, '#' = cero o más)
+y se guardan en un trie por palabra: encontrar los suscriptores de un tópico cuesta
+O(profundidad del tópico) y no O(conexiones)
+"""
+
+from typing import Dict, Hashable, List, Set
+
+MAX_TOPIC_DEPTH = 16
+
+
+def parse_pattern(pattern: str) -> List[str]:
+    """Split a subscription pattern into words, raising ValueError if it is not valid"""
+    if not isinstance(pattern, str) or not pattern:
+        raise ValueError("Topic pattern must be a non-empty string")
+    words = pattern.split(".")
+    if len(words) > MAX_TOPIC_DEPTH:
+        raise ValueError(f"Topic pattern deeper than {MAX_TOPIC_DEPTH} words: {pattern}")
+    if any(not word for word in words):
+        raise ValueError(f"Empty word in topic pattern: {pattern}")
+    return words
+
+
+class _Node:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.subscribers: Set[Hashable] = set()
+
+
+class SubscriptionTrie:
+    """Topic pattern -> subscribers index"""
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, pattern: str, subscriber: Hashable):
+        node = self._root
+        for word in parse_pattern(pattern):
+            node = node.children.setdefault(word, _Node())
+        node.subscribers.add(subscriber)
+
+    def remove(self, pattern: str, subscriber: Hashable):
+        words = parse_pattern(pattern)
+        path = [self._root]
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].subscribers.discard(subscriber)
+
+        # Prune the nodes left without subscribers or children
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.subscribers or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def match(self, topic: str) -> Set[Hashable]:
+        """Subscribers of every pattern matching the topic"""
+        matched: Set[Hashable] = set()
+        self._match(self._root, topic.split("."), 0, matched)
+        return matched
+
+    def _match(self, node: _Node, words: List[str], index: int, matched: Set[Hashable]):
+        hash_node = node.children.get("#")
+        if hash_node is not None:
+            # '#' consumes zero or more words
+            for rest in range(index, len(words) + 1):
+                self._match(hash_node, words, rest, matched)
+
+        if index == len(words):
+            matched.update(node.subscribers)
+            return
+
+        child = node.children.get(words[index])
+        if child is not None:
+            self._match(child, words, index + 1, matched)
+        star = node.children.get("*")
+        if star is not None:
+            self._match(star, words, index + 1, matched)
@@ -5,6 +5,9 @@ Contains common configuration and utilities
 
 from .rabbitmq_config import RABBITMQ_CONFIG, SystemEvents, SERVICE_CONFIGS
 from .rabbitmq_client import RabbitMQClient, EventPublisher, create_rabbitmq_client
+from .event_codec import register_codec, encode_event, decode_event
+from .memory_broker import InMemoryRabbitMQClient
+from .dedup import DedupCache
 
 # Lazy import for websocket_client to avoid requiring websockets package in all services
 def __getattr__(name):
@@ -23,6 +26,11 @@ __all__ = [
     "RabbitMQClient",
     "EventPublisher",
     "create_rabbitmq_client",
+    "InMemoryRabbitMQClient",
+    "DedupCache",
+    "register_codec",
+    "encode_event",
+    "decode_event",
     "WebSocketClient",
     "WebSocketServiceIntegration"
 ]
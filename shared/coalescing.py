@@ -0,0 +1,119 @@
+"""
+Coalescing de eventos frecuentes en el publisher
+Dentro de una ventana de tiempo, los eventos repetidos con la misma clave se descartan
+(mode "drop": sólo sale el primero) o se combinan en uno solo (mode "merge": sale al
+cerrar la ventana)
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from . import rabbitmq_metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCE_DROP = "drop"
+COALESCE_MERGE = "merge"
+
+
+def _last_wins(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    return current
+
+
+class EventCoalescer:
+    """Coalesces one event type by key inside a time window"""
+
+    def __init__(
+        self,
+        service_name: str,
+        event_type: str,
+        window_ms: int,
+        key: Callable[[Dict[str, Any]], Any],
+        publish: Callable[..., Awaitable[None]],
+        mode: str = COALESCE_DROP,
+        merge: Optional[Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]] = None,
+        max_keys: int = 100000
+    ):
+        if mode not in (COALESCE_DROP, COALESCE_MERGE):
+            raise ValueError(f"Unknown coalescing mode: {mode}")
+
+        self.event_type = event_type
+        self.window = window_ms / 1000
+        self.key = key
+        self.publish = publish
+        self.mode = mode
+        self.merge = merge or _last_wins
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._suppressed_metric = metrics.EVENTS_COALESCED.labels(service_name, event_type)
+
+        # drop: fin de la ventana por clave
+        self._windows: Dict[Any, float] = {}
+        # merge: evento acumulado por clave (data, routing_key, headers)
+        self._pending: Dict[Any, Tuple[Dict[str, Any], Optional[str], Optional[Dict[str, Any]]]] = {}
+        self._timers: Dict[Any, asyncio.TimerHandle] = {}
+        self._flushes: set = set()
+
+    async def offer(self, data: Dict[str, Any], routing_key: Optional[str] = None, headers: Optional[Dict[str, Any]] = None) -> bool:
+        """Returns True if the caller must publish the event now, False if it was coalesced"""
+        key = self.key(data)
+        if key is None:
+            return True
+
+        if self.mode == COALESCE_DROP:
+            now = time.monotonic()
+            window_end = self._windows.get(key)
+            if window_end is not None and window_end > now:
+                self._count_suppressed()
+                return False
+            if len(self._windows) >= self.max_keys:
+                self._purge_expired(now)
+            self._windows[key] = now + self.window
+            return True
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self._pending[key] = (self.merge(pending[0], data), routing_key or pending[1], pending[2])
+            self._count_suppressed()
+        else:
+            self._pending[key] = (data, routing_key, headers)
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._schedule_flush, key)
+        return False
+
+    async def close(self):
+        """Publish every pending merged event"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for key in list(self._pending):
+            await self._flush(key)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _schedule_flush(self, key: Any):
+        self._timers.pop(key, None)
+        task = asyncio.create_task(self._flush(key))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, key: Any):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        data, routing_key, headers = pending
+        try:
+            await self.publish(self.event_type, data, routing_key, headers)
+        except Exception as e:
+            logger.error(f"Error publicando evento combinado '{self.event_type}': {e}")
+
+    def _count_suppressed(self):
+        self.suppressed += 1
+        self._suppressed_metric.inc()
+
+    def _purge_expired(self, now: float):
+        for key in [key for key, window_end in self._windows.items() if window_end <= now]:
+            del self._windows[key]
+        # Si siguen siendo demasiadas, se olvidan las más viejas
+        while len(self._windows) >= self.max_keys:
+            del self._windows[next(iter(self._windows))]
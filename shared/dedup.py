@@ -0,0 +1,117 @@
+"""
+Capa de idempotencia para consumers
+Recuerda los message_id ya procesados (LRU + TTL en memoria, opcionalmente respaldado
+en Mongo o Postgres) para no repetir trabajo cuando RabbitMQ reentrega mensajes
+"""
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MongoDedupStore:
+    """Processed message ids in a Mongo collection (motor), expired by a TTL index"""
+
+    def __init__(self, collection, ttl_seconds: int):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+
+    async def setup(self):
+        await self.collection.create_index("processed_at", expireAfterSeconds=self.ttl_seconds)
+
+    async def exists(self, message_id: str) -> bool:
+        return await self.collection.find_one({"_id": message_id}, projection={"_id": 1}) is not None
+
+    async def add(self, message_id: str):
+        await self.collection.update_one(
+            {"_id": message_id},
+            {"$setOnInsert": {"processed_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+
+class PostgresDedupStore:
+    """Processed message ids in a Postgres table (asyncpg pool)"""
+
+    def __init__(self, pool, ttl_seconds: int, table: str = "processed_messages"):
+        self.pool = pool
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+
+    async def setup(self):
+        async with self.pool.acquire() as connection:
+            await connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "message_id TEXT PRIMARY KEY, processed_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        await self.purge_expired()
+
+    async def purge_expired(self):
+        """Delete ids older than the TTL (Postgres has no TTL index)"""
+        async with self.pool.acquire() as connection:
+            await connection.execute(
+                f"DELETE FROM {self.table} WHERE processed_at < now() - $1::interval",
+                timedelta(seconds=self.ttl_seconds)
+            )
+
+    async def exists(self, message_id: str) -> bool:
+        async with self.pool.acquire() as connection:
+            return await connection.fetchval(f"SELECT 1 FROM {self.table} WHERE message_id = $1", message_id) is not None
+
+    async def add(self, message_id: str):
+        async with self.pool.acquire() as connection:
+            await connection.execute(
+                f"INSERT INTO {self.table} (message_id) VALUES ($1) ON CONFLICT DO NOTHING", message_id
+            )
+
+
+class DedupCache:
+    """Bounded LRU + TTL set of processed message ids, with an optional persistent store"""
+
+    def __init__(self, max_size: int = 100000, ttl_seconds: int = 3600, store=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    async def is_duplicate(self, message_id: Optional[str]) -> bool:
+        """True if the message was already processed (messages without id are never duplicates)"""
+        if not message_id:
+            return False
+
+        expires_at = self._seen.get(message_id)
+        if expires_at is not None:
+            if expires_at > time.monotonic():
+                self._seen.move_to_end(message_id)
+                return True
+            del self._seen[message_id]
+
+        if self.store is not None:
+            try:
+                if await self.store.exists(message_id):
+                    self._remember_locally(message_id)
+                    return True
+            except Exception as e:
+                # Si el store no responde es preferible procesar de nuevo que perder el mensaje
+                logger.error(f"Error consultando el dedup store: {e}")
+        return False
+
+    async def remember(self, message_id: Optional[str]):
+        """Mark a message as processed"""
+        if not message_id:
+            return
+        self._remember_locally(message_id)
+        if self.store is not None:
+            try:
+                await self.store.add(message_id)
+            except Exception as e:
+                logger.error(f"Error guardando {message_id} en el dedup store: {e}")
+
+    def _remember_locally(self, message_id: str):
+        self._seen[message_id] = time.monotonic() + self.ttl_seconds
+        self._seen.move_to_end(message_id)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
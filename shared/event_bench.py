@@ -0,0 +1,115 @@
+"""
+Benchmark del pipeline de eventos sobre el broker en memoria
+Recorre el camino upload -> moderación -> notificación por websocket con el código real de
+RabbitMQClient/EventPublisher (queues por servicio de SERVICE_CONFIGS, workers, confirms,
+buffer de publicación) en un solo proceso. Los handlers son sustitutos livianos de los de
+cada servicio: mide la capa de eventos, no las apps FastAPI ni sus bases de datos.
+
+    python -m shared.event_bench --events 20000 --buffered
+"""
+import argparse
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from .memory_broker import InMemoryBroker, InMemoryRabbitMQClient
+from .rabbitmq_client import EventPublisher
+from .rabbitmq_config import SystemEvents
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run(
+    events: int,
+    publishers: int = 50,
+    buffered: bool = False,
+    concurrency: Optional[int] = None,
+    timeout: float = 120.0
+) -> Dict[str, float]:
+    """Publish events from content-service and wait until websocket-service saw all of them"""
+    broker = InMemoryBroker()
+    content = InMemoryRabbitMQClient("content-service", broker)
+    moderation = InMemoryRabbitMQClient("moderation-service", broker)
+    websocket = InMemoryRabbitMQClient("websocket-service", broker)
+    for client in (content, moderation, websocket):
+        await client.connect()
+
+    content_publisher = EventPublisher(content, buffered=buffered)
+    moderation_publisher = EventPublisher(moderation, buffered=buffered)
+
+    moderated_at: Dict[int, float] = {}
+    hop_latency: List[float] = []
+    end_to_end: List[float] = []
+    publish_latency: List[float] = []
+    finished = asyncio.Event()
+
+    async def moderate(event_type: str, message: dict):
+        # Como handle_content_event: aprueba y publica moderation.approved
+        data = message["data"]
+        moderated_at[data["seq"]] = time.perf_counter()
+        await moderation_publisher.publish_event(SystemEvents.MODERATION_APPROVED, data)
+
+    async def notify(event_type: str, message: dict):
+        data = message["data"]
+        now = time.perf_counter()
+        hop_latency.append(now - moderated_at.pop(data["seq"], now))
+        end_to_end.append(now - data["sent_at"])
+        if len(end_to_end) >= events:
+            finished.set()
+
+    await moderation.consume_events([SystemEvents.CONTENT_CREATED], moderate, concurrency=concurrency)
+    await websocket.consume_events([SystemEvents.MODERATION_APPROVED], notify, concurrency=concurrency)
+
+    async def publisher(worker: int):
+        # Cada worker hace de un request HTTP tras otro
+        for seq in range(worker, events, publishers):
+            started = time.perf_counter()
+            await content_publisher.publish_event(SystemEvents.CONTENT_CREATED, {"seq": seq, "sent_at": started})
+            publish_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(publisher(worker) for worker in range(min(publishers, events))))
+    try:
+        await asyncio.wait_for(finished.wait(), timeout)
+    finally:
+        elapsed = time.perf_counter() - started
+        await content_publisher.close()
+        await moderation_publisher.close()
+        for client in (content, moderation, websocket):
+            await client.disconnect()
+
+    return {
+        "events": len(end_to_end),
+        "seconds": elapsed,
+        "events_per_second": len(end_to_end) / elapsed if elapsed else 0.0,
+        "publish_p50_ms": percentile(publish_latency, 0.5) * 1000,
+        "publish_p99_ms": percentile(publish_latency, 0.99) * 1000,
+        "notify_hop_p50_ms": percentile(hop_latency, 0.5) * 1000,
+        "notify_hop_p99_ms": percentile(hop_latency, 0.99) * 1000,
+        "end_to_end_p50_ms": percentile(end_to_end, 0.5) * 1000,
+        "end_to_end_p99_ms": percentile(end_to_end, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the event pipeline on the in-memory broker")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--publishers", type=int, default=50, help="concurrent publishing 'requests'")
+    parser.add_argument("--buffered", action="store_true", help="publish through the PublishBuffer")
+    parser.add_argument("--concurrency", type=int, default=None, help="workers per consumer queue")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = asyncio.run(run(args.events, args.publishers, args.buffered, args.concurrency))
+    for name, value in result.items():
+        print(f"{name:>20}: {value:,.2f}")
+
+
+if __name__ == "__main__":
+    main()
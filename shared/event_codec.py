@@ -0,0 +1,105 @@
+"""
+Codecs para serializar eventos de RabbitMQ
+El content_type del mensaje indica con qué codec se decodifica el body
+"""
+import json
+import os
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Dependencias opcionales: si no están instaladas se usa json de la stdlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+
+class EventCodec:
+    """Encoder/decoder pair registered for a content type"""
+
+    def __init__(self, content_type: str, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any]):
+        self.content_type = content_type
+        self.encode = encode
+        self.decode = decode
+
+
+_codecs: Dict[str, EventCodec] = {}
+
+
+def register_codec(content_type: str, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any]):
+    """Register (or replace) the codec for a content type"""
+    _codecs[content_type] = EventCodec(content_type, encode, decode)
+
+
+def get_codec(content_type: Optional[str]) -> EventCodec:
+    """Get the codec for a content type; messages without one (old producers) are JSON"""
+    codec = _codecs.get(content_type or JSON_CONTENT_TYPE)
+    if codec is None:
+        raise ValueError(f"Unsupported event content type: {content_type}")
+    return codec
+
+
+def get_default_codec() -> EventCodec:
+    """Codec used to publish: RABBITMQ_EVENT_CODEC or the fastest one available"""
+    content_type = os.getenv("RABBITMQ_EVENT_CODEC")
+    if content_type:
+        return get_codec(content_type)
+    if MSGPACK_CONTENT_TYPE in _codecs:
+        return _codecs[MSGPACK_CONTENT_TYPE]
+    return _codecs[JSON_CONTENT_TYPE]
+
+
+def encode_event(data: Any, content_type: Optional[str] = None) -> Tuple[bytes, str]:
+    """Encode an event, returns (body, content_type)"""
+    codec = get_codec(content_type) if content_type else get_default_codec()
+    return codec.encode(data), codec.content_type
+
+
+def decode_event(body: bytes, content_type: Optional[str] = None) -> Any:
+    """Decode a message body according to its content type"""
+    return get_codec(content_type).decode(body)
+
+
+def dumps_json(data: Any) -> str:
+    """Serialize to a JSON string with the fastest encoder available"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default).decode()
+    return json.dumps(data, default=_json_default)
+
+
+def _json_default(value: Any) -> Any:
+    # Tipos no serializables (datetime, ObjectId, ...) se envían como string
+    return str(value)
+
+
+# JSON: orjson si está disponible, compatible con productores viejos
+if orjson is not None:
+    register_codec(
+        JSON_CONTENT_TYPE,
+        lambda data: orjson.dumps(data, default=_json_default),
+        orjson.loads
+    )
+else:
+    register_codec(
+        JSON_CONTENT_TYPE,
+        lambda data: json.dumps(data, default=_json_default).encode(),
+        lambda body: json.loads(body.decode())
+    )
+
+# MessagePack: codec binario por defecto cuando está instalado
+if msgpack is not None:
+    register_codec(
+        MSGPACK_CONTENT_TYPE,
+        lambda data: msgpack.packb(data, use_bin_type=True, default=_json_default),
+        lambda body: msgpack.unpackb(body, raw=False)
+    )
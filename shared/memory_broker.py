@@ -0,0 +1,342 @@
+"""
+Broker en memoria que reemplaza a RabbitMQ para tests y benchmarks
+Se activa con EVENT_BROKER=memory. Implementa la parte de la API de aio_pika que usa
+RabbitMQClient (conexión, canales, exchanges topic, queues, acks, TTL y dead letter),
+así retries, DLQ, lotes y workers se comportan igual que contra RabbitMQ.
+Todos los clientes del mismo proceso comparten el broker; los servicios corren en procesos
+separados y no lo comparten entre sí, así que las mediciones de punta a punta se hacen con
+shared.event_bench, que arma el pipeline entre servicios dentro de un solo proceso.
+"""
+import asyncio
+import itertools
+import logging
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .rabbitmq_client import RabbitMQClient
+
+logger = logging.getLogger(__name__)
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """Check a routing key against a topic binding key ('*' = one word, '#' = zero or more words)"""
+    return _match_words(tuple(pattern.split(".")), tuple(routing_key.split(".")))
+
+
+@lru_cache(maxsize=4096)
+def _match_words(pattern: Tuple[str, ...], words: Tuple[str, ...]) -> bool:
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == "#":
+        return any(_match_words(rest, words[index:]) for index in range(len(words) + 1))
+    if not words:
+        return False
+    return (head == "*" or head == words[0]) and _match_words(rest, words[1:])
+
+
+class _Envelope:
+    """A published message as stored by the broker"""
+
+    __slots__ = ("body", "routing_key", "content_type", "headers", "message_id", "correlation_id", "redelivered")
+
+    def __init__(self, body: bytes, routing_key: str, content_type=None, headers=None, message_id=None, correlation_id=None):
+        self.body = body
+        self.routing_key = routing_key
+        self.content_type = content_type
+        self.headers = dict(headers or {})
+        self.message_id = message_id
+        self.correlation_id = correlation_id
+        self.redelivered = False
+
+
+class _QueueState:
+    """Broker side of a queue: pending messages and its arguments"""
+
+    def __init__(self, broker: "InMemoryBroker", name: str, arguments: Optional[Dict[str, Any]]):
+        self.broker = broker
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.consumer_count = 0
+
+    def put(self, envelope: _Envelope):
+        ttl = self.arguments.get("x-message-ttl")
+        if ttl is not None and "x-dead-letter-exchange" in self.arguments:
+            # Queue de retardo: al vencer el TTL el mensaje pasa al dead letter exchange
+            routing_key = self.arguments.get("x-dead-letter-routing-key", envelope.routing_key)
+            asyncio.get_running_loop().call_later(
+                ttl / 1000, self.broker.route, self.arguments["x-dead-letter-exchange"], routing_key, envelope
+            )
+        else:
+            self.messages.put_nowait(envelope)
+
+
+class InMemoryBroker:
+    """Process-wide exchanges, bindings and queues"""
+
+    def __init__(self):
+        self.exchanges: Dict[str, str] = {}
+        self.queues: Dict[str, _QueueState] = {}
+        self.bindings: Dict[str, List[Tuple[str, _QueueState]]] = {}
+
+    def declare_exchange(self, name: str, exchange_type: str = "topic"):
+        self.exchanges.setdefault(name, exchange_type)
+
+    def declare_queue(self, name: str, arguments: Optional[Dict[str, Any]] = None) -> _QueueState:
+        if name not in self.queues:
+            self.queues[name] = _QueueState(self, name, arguments)
+        return self.queues[name]
+
+    def bind(self, exchange_name: str, routing_key: str, queue: _QueueState):
+        bindings = self.bindings.setdefault(exchange_name, [])
+        if (routing_key, queue) not in bindings:
+            bindings.append((routing_key, queue))
+
+    def route(self, exchange_name: str, routing_key: str, envelope: _Envelope) -> int:
+        """Deliver a message to every queue bound to the exchange with a matching key"""
+        if exchange_name == "":
+            # Default exchange: routing key = nombre de la queue
+            targets = [self.queues[routing_key]] if routing_key in self.queues else []
+        else:
+            targets = []
+            for pattern, queue in self.bindings.get(exchange_name, []):
+                if queue not in targets and topic_matches(pattern, routing_key):
+                    targets.append(queue)
+
+        for queue in targets:
+            queue.put(_Envelope(
+                envelope.body, routing_key, envelope.content_type, envelope.headers,
+                envelope.message_id, envelope.correlation_id
+            ))
+        if not targets:
+            logger.debug(f"Mensaje sin queue destino en '{exchange_name}' con routing key '{routing_key}'")
+        return len(targets)
+
+    def reset(self):
+        """Drop every exchange, queue and binding"""
+        self.exchanges.clear()
+        self.queues.clear()
+        self.bindings.clear()
+
+
+class InMemoryIncomingMessage:
+    """Delivered message with the ack/nack API of aio_pika's IncomingMessage"""
+
+    def __init__(self, channel: "InMemoryChannel", queue: _QueueState, envelope: _Envelope, delivery_tag: int):
+        self.channel = channel
+        self.queue = queue
+        self.envelope = envelope
+        self.delivery_tag = delivery_tag
+        self.processed = False
+
+    body = property(lambda self: self.envelope.body)
+    routing_key = property(lambda self: self.envelope.routing_key)
+    content_type = property(lambda self: self.envelope.content_type)
+    headers = property(lambda self: self.envelope.headers)
+    message_id = property(lambda self: self.envelope.message_id)
+    correlation_id = property(lambda self: self.envelope.correlation_id)
+    redelivered = property(lambda self: self.envelope.redelivered)
+
+    async def ack(self, multiple: bool = False):
+        self.channel._settle(self, multiple, requeue=False)
+
+    async def nack(self, multiple: bool = False, requeue: bool = True):
+        self.channel._settle(self, multiple, requeue=requeue)
+
+    async def reject(self, requeue: bool = False):
+        self.channel._settle(self, False, requeue=requeue)
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False):
+        try:
+            yield self
+        except Exception:
+            if not self.processed:
+                await self.reject(requeue=requeue)
+            raise
+        else:
+            if not self.processed:
+                await self.ack()
+
+
+class _QueueIterator:
+    """Async iterator returned by InMemoryQueue.iterator()"""
+
+    def __init__(self, queue: "InMemoryQueue"):
+        self.queue = queue
+
+    async def __aenter__(self):
+        self.queue.state.consumer_count += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.queue.state.consumer_count -= 1
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> InMemoryIncomingMessage:
+        return await self.queue._next()
+
+
+class InMemoryQueue:
+    """Channel side of a queue, mirrors aio_pika's Queue"""
+
+    def __init__(self, channel: "InMemoryChannel", state: _QueueState):
+        self.channel = channel
+        self.state = state
+        self.name = state.name
+        self._consumers: Dict[str, asyncio.Task] = {}
+
+    @property
+    def declaration_result(self) -> SimpleNamespace:
+        """Queue stats, like the Queue.DeclareOk of a passive declare"""
+        return SimpleNamespace(message_count=self.state.messages.qsize(), consumer_count=self.state.consumer_count)
+
+    async def bind(self, exchange: "InMemoryExchange", routing_key: str):
+        self.channel.broker.bind(exchange.name, routing_key, self.state)
+
+    async def _next(self) -> InMemoryIncomingMessage:
+        envelope = await self.state.messages.get()
+        return self.channel._deliver(self.state, envelope)
+
+    def iterator(self) -> _QueueIterator:
+        return _QueueIterator(self)
+
+    async def consume(self, callback: Callable) -> str:
+        consumer_tag = f"ctag-{next(self.channel._consumer_tags)}"
+
+        async def run():
+            while True:
+                await callback(await self._next())
+
+        self._consumers[consumer_tag] = asyncio.create_task(run())
+        self.state.consumer_count += 1
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str):
+        task = self._consumers.pop(consumer_tag, None)
+        if task:
+            task.cancel()
+            self.state.consumer_count -= 1
+
+    async def get(self, fail: bool = True, no_ack: bool = False) -> Optional[InMemoryIncomingMessage]:
+        try:
+            envelope = self.state.messages.get_nowait()
+        except asyncio.QueueEmpty:
+            if fail:
+                raise
+            return None
+        message = self.channel._deliver(self.state, envelope)
+        if no_ack:
+            await message.ack()
+        return message
+
+
+class InMemoryExchange:
+    """Exchange handle, mirrors aio_pika's Exchange.publish"""
+
+    def __init__(self, broker: InMemoryBroker, name: str):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key: str, **kwargs):
+        self.broker.route(self.name, routing_key, _Envelope(
+            message.body, routing_key, message.content_type, message.headers,
+            message.message_id, message.correlation_id
+        ))
+
+
+class InMemoryChannel:
+    """Channel with its own delivery tags and unacked messages, like an AMQP channel"""
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self._consumer_tags = itertools.count(1)
+        self._delivery_tags = itertools.count(1)
+        self._unacked: Dict[int, InMemoryIncomingMessage] = {}
+        self.is_closed = False
+
+    async def set_qos(self, prefetch_count: int = 0, **kwargs):
+        # Sin red no hay prefetch que limitar; la concurrencia la acota el consumer
+        pass
+
+    async def declare_exchange(self, name: str, exchange_type=None, durable: bool = True, **kwargs) -> InMemoryExchange:
+        self.broker.declare_exchange(name)
+        return InMemoryExchange(self.broker, name)
+
+    async def get_exchange(self, name: str, ensure: bool = True) -> InMemoryExchange:
+        return InMemoryExchange(self.broker, name)
+
+    async def declare_queue(self, name: str, durable: bool = False, arguments: Optional[Dict[str, Any]] = None, **kwargs) -> InMemoryQueue:
+        return InMemoryQueue(self, self.broker.declare_queue(name, arguments))
+
+    def _deliver(self, queue: _QueueState, envelope: _Envelope) -> InMemoryIncomingMessage:
+        message = InMemoryIncomingMessage(self, queue, envelope, next(self._delivery_tags))
+        self._unacked[message.delivery_tag] = message
+        return message
+
+    def _settle(self, message: InMemoryIncomingMessage, multiple: bool, requeue: bool):
+        if multiple:
+            settled = [tag for tag in self._unacked if tag <= message.delivery_tag]
+        else:
+            settled = [message.delivery_tag] if message.delivery_tag in self._unacked else []
+
+        for tag in settled:
+            pending = self._unacked.pop(tag)
+            pending.processed = True
+            if requeue:
+                pending.envelope.redelivered = True
+                pending.queue.messages.put_nowait(pending.envelope)
+
+    async def close(self):
+        # Como en AMQP, lo que quedó sin ack vuelve a su queue
+        for message in list(self._unacked.values()):
+            self._settle(message, False, requeue=True)
+        self.is_closed = True
+
+
+class InMemoryConnection:
+    """Connection handle that opens InMemoryChannel instances"""
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.channels: List[InMemoryChannel] = []
+        self.is_closed = False
+
+    async def channel(self, **kwargs) -> InMemoryChannel:
+        channel = InMemoryChannel(self.broker)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+        self.is_closed = True
+
+
+# Broker compartido por todos los clientes del proceso
+memory_broker = InMemoryBroker()
+
+
+class InMemoryRabbitMQClient(RabbitMQClient):
+    """RabbitMQClient that talks to the in-process broker instead of RabbitMQ"""
+
+    def __init__(self, service_name: str, broker: Optional[InMemoryBroker] = None):
+        super().__init__(service_name)
+        self.broker = broker or memory_broker
+        self.rabbitmq_url = "memory://"
+
+    async def connect(self):
+        """Conectar al broker en memoria"""
+        self.connection = InMemoryConnection(self.broker)
+        self.channel = await self.connection.channel()
+
+        await self._setup_exchanges()
+        await self._setup_publisher_channels()
+
+        logger.info(f"{self.service_name} conectado al broker en memoria")
@@ -0,0 +1,236 @@
+"""
+Buffer de publicación no bloqueante
+Los eventos se encolan en memoria y una tarea en background los publica por lotes,
+así los handlers HTTP no esperan al broker
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from .event_codec import decode_event, dumps_json, JSON_CONTENT_TYPE
+from . import rabbitmq_metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_SPILL = "spill"
+
+
+class PublishBuffer:
+    """Bounded in-memory queue of events drained by a background flusher"""
+
+    def __init__(
+        self,
+        client,
+        max_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval_ms: int = 20,
+        overflow_policy: str = OVERFLOW_BLOCK,
+        spill_path: Optional[str] = None,
+        shutdown_timeout: float = 10.0
+    ):
+        if overflow_policy not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        if overflow_policy == OVERFLOW_SPILL and not spill_path:
+            raise ValueError("The spill overflow policy needs a spill_path")
+
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.overflow_policy = overflow_policy
+        self.spill_path = spill_path
+        self.shutdown_timeout = shutdown_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_size))
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.size_gauge = metrics.PUBLISH_BUFFER_SIZE.labels(getattr(client, "service_name", ""))
+
+        # Contadores
+        self.published = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def start(self):
+        """Start the background flusher"""
+        if self._flusher is None or self._flusher.done():
+            self._closing = False
+            self._flusher = asyncio.create_task(self._run())
+
+    async def enqueue(
+        self,
+        event_type: str,
+        data: Dict[str, Any],
+        routing_key: Optional[str] = None,
+        headers: Optional[Dict[str, Any]] = None,
+        message_id: Optional[str] = None
+    ):
+        """Add an event to the buffer applying the overflow policy when it is full
+        
+        The message_id travels with the event (and through the spill file) so that
+        every publish attempt of a batch reuses it and consumers can deduplicate.
+        """
+        event = (event_type, data, routing_key, headers, message_id or uuid.uuid4().hex)
+        if self._closing:
+            # Requests que siguen en curso durante el shutdown: no fallan, el evento se guarda o se pierde
+            if self.spill_path:
+                self._spill([event])
+            else:
+                self.dropped += 1
+                logger.error(f"Publish buffer cerrado, se descartó el evento '{event_type}'")
+            return
+        self.start()
+
+        if not self.queue.full():
+            self.queue.put_nowait(event)
+        elif self.overflow_policy == OVERFLOW_BLOCK:
+            await self.queue.put(event)
+        elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            dropped = self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            self.dropped += 1
+            self._count_overflow(1)
+            logger.warning(f"Publish buffer lleno, se descartó el evento '{dropped[0]}'")
+        else:
+            self._spill([event])
+            self._count_overflow(1)
+        self.size_gauge.set(self.queue.qsize())
+
+    async def close(self):
+        """Flush pending events and stop the flusher; leftovers are spilled to disk if possible"""
+        self._closing = True
+        if self._flusher is None:
+            return
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Publish buffer no pudo vaciarse en {self.shutdown_timeout}s")
+
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+
+        leftovers = []
+        while not self.queue.empty():
+            leftovers.append(self.queue.get_nowait())
+            self.queue.task_done()
+        if leftovers:
+            if self.spill_path:
+                self._spill(leftovers)
+            else:
+                self.dropped += len(leftovers)
+                logger.error(f"Se perdieron {len(leftovers)} eventos al cerrar el publish buffer")
+
+    async def _run(self):
+        """Drain the queue in batches and publish them"""
+        # Eventos que quedaron en disco de una ejecución anterior
+        await self._replay_spill_safely()
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._publish(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                self.size_gauge.set(self.queue.qsize())
+
+            if self.queue.empty():
+                await self._replay_spill_safely()
+
+    async def _publish(self, batch: List[Tuple]):
+        """Publish a batch, retrying with backoff while the broker is unavailable"""
+        delay = 0.1
+        while True:
+            try:
+                await self.client.publish_many(batch)
+                self.published += len(batch)
+                return
+            except asyncio.CancelledError:
+                # Cerrando: no perder el lote en vuelo
+                if self.spill_path:
+                    self._spill(batch)
+                raise
+            except Exception as e:
+                logger.error(f"Error publicando lote de {len(batch)} eventos, reintentando en {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    def _count_overflow(self, count: int):
+        metrics.PUBLISH_BUFFER_OVERFLOW.labels(getattr(self.client, "service_name", ""), self.overflow_policy).inc(count)
+
+    def _spill(self, events: List[Tuple]):
+        """Append events to the spill file (JSON lines)"""
+        with open(self.spill_path, "a") as spill_file:
+            for event_type, data, routing_key, headers, message_id in events:
+                spill_file.write(dumps_json({
+                    "event_type": event_type, "data": data, "routing_key": routing_key, "headers": headers,
+                    "message_id": message_id
+                }) + "\n")
+        self.spilled += len(events)
+        logger.warning(f"{len(events)} eventos guardados en disco ({self.spill_path})")
+
+    async def _replay_spill_safely(self):
+        """Replay the spill file without letting a bad file stop the flusher"""
+        try:
+            await self._replay_spill()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            replay_path = f"{self.spill_path}.replay"
+            failed_path = f"{replay_path}.failed-{int(time.time())}"
+            logger.error(f"No se pudieron publicar los eventos guardados en {replay_path}: {e}")
+            # Se aparta el archivo para revisarlo a mano; el buffer sigue publicando
+            try:
+                os.replace(replay_path, failed_path)
+                logger.error(f"Archivo movido a {failed_path}")
+            except OSError as move_error:
+                logger.error(f"No se pudo mover {replay_path}: {move_error}")
+
+    async def _replay_spill(self):
+        """Publish events previously spilled to disk"""
+        if not self.spill_path:
+            return
+
+        # Un .replay que quedó de una ejecución interrumpida se publica primero
+        replay_path = f"{self.spill_path}.replay"
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as spill_file:
+            # Líneas sin message_id (escritas por una versión anterior) reciben uno ahora, antes de reintentar
+            events = [
+                (
+                    event["event_type"], event["data"], event.get("routing_key"), event.get("headers"),
+                    event.get("message_id") or uuid.uuid4().hex
+                )
+                for event in (decode_event(line.encode(), JSON_CONTENT_TYPE) for line in spill_file if line.strip())
+            ]
+
+        for start in range(0, len(events), self.batch_size):
+            await self._publish(events[start:start + self.batch_size])
+        os.remove(replay_path)
+        logger.info(f"Se publicaron {len(events)} eventos guardados en disco")
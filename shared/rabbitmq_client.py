@@ -2,16 +2,23 @@
 Cliente RabbitMQ compartido para todos los microservicios
 Implementa patrones Publisher/Subscriber y Message Queue
 """
-import json
 import asyncio
 import logging
-from typing import Any, Dict, Optional, Callable, List
+import time
+import uuid
+from typing import Any, Dict, Optional, Callable, List, Tuple
 from datetime import datetime
 import aio_pika
 from aio_pika import Message, DeliveryMode, ExchangeType
-from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.abc import AbstractIncomingMessage, AbstractChannel, AbstractExchange
 
 from .rabbitmq_config import RABBITMQ_CONFIG, SystemEvents, SERVICE_CONFIGS
+from .event_codec import encode_event, decode_event
+from .publish_buffer import PublishBuffer
+from . import rabbitmq_metrics as metrics
+from . import tracing
+from .dedup import DedupCache
+from .coalescing import EventCoalescer, COALESCE_DROP
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +32,24 @@ class RabbitMQClient:
         self.rabbitmq_url = RABBITMQ_CONFIG["url"]
         self.consumers: Dict[str, asyncio.Task] = {}
         
+        # Pool de canales para publicar (con publisher confirms)
+        publisher_config = RABBITMQ_CONFIG["publisher_config"]
+        self.publisher_pool_size = max(1, publisher_config["channel_pool_size"])
+        self.confirm_batch_size = max(1, publisher_config["confirm_batch_size"])
+        self._publisher_channels: List[AbstractChannel] = []
+        # Exchanges resueltos una sola vez, uno por canal del pool
+        self._exchange_cache: List[Dict[str, AbstractExchange]] = []
+        self._next_publisher = 0
+        # publish_event concurrentes que esperan un mismo flush de confirms
+        self._confirm_waiters: List[Tuple[str, str, Message, asyncio.Future]] = []
+        self._confirm_flush: Optional[asyncio.Task] = None
+        
+        # Retry y dead letter
+        self.retry_config = RABBITMQ_CONFIG["retry_config"]
+        
+        # Queues consumidas, para medir su profundidad
+        self._consumer_queues: set = set()
+        
     async def connect(self):
         """Conectar a RabbitMQ"""
         try:
@@ -41,6 +66,9 @@ class RabbitMQClient:
             # Configurar exchanges
             await self._setup_exchanges()
             
+            # Canales dedicados a publicar
+            await self._setup_publisher_channels()
+            
             logger.info(f"{self.service_name} conectado a RabbitMQ")
         except Exception as e:
             logger.error(f"Error conectando {self.service_name} a RabbitMQ: {e}")
@@ -55,6 +83,38 @@ class RabbitMQClient:
                 durable=exchange_config["durable"]
             )
             logger.debug(f"Exchange '{exchange_config['name']}' configurado")
+        
+        # Dead letter exchange y queue para mensajes que agotaron los reintentos
+        dlx = await self.channel.declare_exchange(
+            self.retry_config["dead_letter_exchange"],
+            ExchangeType.TOPIC,
+            durable=True
+        )
+        dlq = await self.channel.declare_queue(self.retry_config["dead_letter_queue"], durable=True)
+        await dlq.bind(dlx, "#")
+
+    async def _setup_publisher_channels(self):
+        """Open the publisher channel pool with publisher confirms enabled"""
+        self._publisher_channels = []
+        self._exchange_cache = []
+        for _ in range(self.publisher_pool_size):
+            channel = await self.connection.channel(publisher_confirms=True)
+            self._publisher_channels.append(channel)
+            self._exchange_cache.append({})
+        self._next_publisher = 0
+
+    async def _get_publisher_exchange(self, exchange_name: str) -> AbstractExchange:
+        """Get a cached exchange on the next publisher channel (round robin)"""
+        index = self._next_publisher
+        self._next_publisher = (index + 1) % len(self._publisher_channels)
+        
+        cache = self._exchange_cache[index]
+        exchange = cache.get(exchange_name)
+        if exchange is None:
+            # Los exchanges ya fueron declarados en _setup_exchanges, no hace falta otro round trip
+            exchange = await self._publisher_channels[index].get_exchange(exchange_name, ensure=False)
+            cache[exchange_name] = exchange
+        return exchange
 
     async def disconnect(self):
         """Desconectar de RabbitMQ"""
@@ -66,102 +126,660 @@ class RabbitMQClient:
             except asyncio.CancelledError:
                 pass
         
+        # Los publish_event en curso reciben su confirm antes de cerrar la conexión
+        if self._confirm_flush is not None:
+            await asyncio.gather(self._confirm_flush, return_exceptions=True)
+        
         if self.connection and not self.connection.is_closed:
             await self.connection.close()
             logger.info(f"{self.service_name} desconectado de RabbitMQ")
+        
+        self.channel = None
+        self._publisher_channels = []
+        self._exchange_cache = []
+        self.consumers = {}
+        self._consumer_queues = set()
 
-    async def publish_event(self, event_type: str, data: Dict[str, Any], routing_key: Optional[str] = None):
-        """Publicar evento en RabbitMQ"""
-        if not self.channel:
+    async def publish_event(
+        self,
+        event_type: str,
+        data: Dict[str, Any],
+        routing_key: Optional[str] = None,
+        trace_headers: Optional[Dict[str, Any]] = None,
+        message_id: Optional[str] = None
+    ):
+        """Publicar evento en RabbitMQ
+        
+        Waits for the broker confirm of this event. Concurrent calls share one
+        pipelined flush, so their confirms are awaited together instead of one
+        round trip after another; the caller still waits one confirm round trip.
+        Only the buffered mode (EventPublisher with a PublishBuffer) takes the
+        broker out of the request path.
+        """
+        if not self._publisher_channels:
             await self.connect()
         
         # Encontrar el exchange correcto basado en el tipo de evento
-        exchange_name = self._get_exchange_for_event(event_type)
-        exchange = await self.channel.declare_exchange(
-            exchange_name,
-            ExchangeType.TOPIC,
-            durable=True
-        )
+        message = self._build_message(event_type, data, trace_headers, message_id)
+        future = asyncio.get_running_loop().create_future()
+        # Usar routing_key personalizado o el por defecto
+        self._confirm_waiters.append((self._get_exchange_for_event(event_type), routing_key or event_type, message, future))
+        if self._confirm_flush is None:
+            self._confirm_flush = asyncio.create_task(self._flush_confirm_waiters())
+        await future
+        
+        logger.info(f"{self.service_name} published event '{event_type}'")
+        logger.debug(f"{self.service_name} event '{event_type}' payload: {data}")
+
+    async def publish_many(self, events: List[Tuple]):
+        """Publish many events as (event_type, data[, routing_key[, headers[, message_id]]]) tuples in one batched flush"""
+        items = []
+        for event in events:
+            event_type, data = event[0], event[1]
+            routing_key = event[2] if len(event) > 2 else None
+            headers = event[3] if len(event) > 3 else None
+            message_id = event[4] if len(event) > 4 else None
+            items.append((
+                self._get_exchange_for_event(event_type),
+                routing_key or event_type,
+                self._build_message(event_type, data, headers, message_id)
+            ))
+        
+        await self._publish_batch(items)
+        logger.info(f"{self.service_name} published {len(items)} events")
+
+    async def _flush_confirm_waiters(self):
+        """Publish the events queued by concurrent publish_event calls and resolve their futures"""
+        # Una vuelta del event loop para juntar los publish_event concurrentes
+        await asyncio.sleep(0)
+        waiters, self._confirm_waiters = self._confirm_waiters, []
+        self._confirm_flush = None
+        
+        results: List[Any] = []
+        try:
+            for start in range(0, len(waiters), self.confirm_batch_size):
+                batch = []
+                for exchange_name, routing_key, message, _ in waiters[start:start + self.confirm_batch_size]:
+                    batch.append((await self._get_publisher_exchange(exchange_name), routing_key, message))
+                results.extend(await self._publish_pipelined(batch))
+        except BaseException as e:
+            results.extend([e] * (len(waiters) - len(results)))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            for (_, _, _, future), result in zip(waiters, results):
+                if future.done():
+                    continue
+                if isinstance(result, asyncio.CancelledError):
+                    future.cancel()
+                elif isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(None)
+
+    async def _publish_pipelined(self, batch: List[Tuple[AbstractExchange, str, Message]]) -> List[Any]:
+        """Send publishes back to back and await their confirms together, returns one result per message"""
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            exchange.publish(message, routing_key=routing_key)
+            for exchange, routing_key, message in batch
+        ), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        
+        for (_, _, message), result in zip(batch, results):
+            event_type = message.headers.get("event_type", "")
+            if isinstance(result, BaseException):
+                metrics.PUBLISH_FAILURES.labels(self.service_name, event_type).inc()
+            else:
+                metrics.PUBLISH_LATENCY.labels(self.service_name, event_type).observe(elapsed)
+        return results
+
+    async def _publish_batch(self, items: List[Tuple[str, str, Message]]):
+        """Publish (exchange_name, routing_key, message) tuples awaiting confirms once per batch"""
+        if not items:
+            return
+        if not self._publisher_channels:
+            await self.connect()
+        
+        # Agrupar por exchange: cada grupo sale por un solo canal y conserva su orden
+        groups: Dict[str, List[Tuple[str, Message]]] = {}
+        for exchange_name, routing_key, message in items:
+            groups.setdefault(exchange_name, []).append((routing_key, message))
+        
+        pending = []
+        for exchange_name, messages in groups.items():
+            exchange = await self._get_publisher_exchange(exchange_name)
+            pending.extend((exchange, routing_key, message) for routing_key, message in messages)
+        
+        # Los publish se envían en pipeline y los confirms se esperan por lote
+        for start in range(0, len(pending), self.confirm_batch_size):
+            results = await self._publish_pipelined(pending[start:start + self.confirm_batch_size])
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                raise errors[0]
+
+    def _build_message(
+        self,
+        event_type: str,
+        data: Dict[str, Any],
+        trace_headers: Optional[Dict[str, Any]] = None,
+        message_id: Optional[str] = None
+    ) -> Message:
+        """Build the persistent AMQP message for an event
         
-        # Crear mensaje
+        trace_headers are the tracing headers captured when the event was
+        created; by default they come from the current request/handler.
+        message_id is the id assigned when the event was created, so that a
+        retried publish carries the same id; a new one is minted if missing.
+        """
+        trace_headers = trace_headers or tracing.outgoing_headers()
+        timestamp = datetime.now().isoformat()
         message_data = {
             "event_type": event_type,
             "service": self.service_name,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp,
             "data": data,
             "version": "1.0"
         }
         
-        message_body = json.dumps(message_data).encode()
-        message = Message(
-            message_body,
+        body, content_type = encode_event(message_data)
+        return Message(
+            body,
             delivery_mode=DeliveryMode.PERSISTENT,
+            content_type=content_type,
+            # Id estable: se conserva en reintentos y reentregas para poder deduplicar
+            message_id=message_id or uuid.uuid4().hex,
+            correlation_id=trace_headers[tracing.TRACE_ID_HEADER],
             headers={
                 "service": self.service_name,
                 "event_type": event_type,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": timestamp,
+                # Epoch para medir el lag de los consumers sin parsear fechas
+                "published_at": time.time(),
+                **trace_headers
             }
         )
-        
-        # Usar routing_key personalizado o el por defecto
-        final_routing_key = routing_key or event_type
-        
-        # Publicar mensaje
-        await exchange.publish(message, routing_key=final_routing_key)
-        
-        logger.info(f"{self.service_name} published event '{event_type}': {data}")
 
-    async def consume_events(self, event_types: List[str], callback: Callable):
-        """Consume specific events"""
+    async def consume_events(
+        self,
+        event_types: List[str],
+        callback: Callable,
+        prefetch_count: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        ordering_key: Optional[Callable[[Dict[str, Any]], Any]] = None,
+        dedup: Optional[DedupCache] = None
+    ):
+        """Consume specific events
+        
+        Each queue gets its own channel with the configured prefetch and a
+        bounded pool of workers. If ordering_key is given, messages that map
+        to the same (non None) key are processed one after another. With a
+        dedup cache, messages whose message_id was already processed are
+        acked without calling the callback.
+        """
         if not self.channel:
             await self.connect()
         
+        consumer_config = RABBITMQ_CONFIG["consumer_config"]
+        
         # Configurar queues para los eventos
         for event_type in event_types:
             queue_config = self._get_queue_config_for_event(event_type)
+            queue_prefetch = prefetch_count or queue_config.get("prefetch_count", consumer_config["prefetch_count"])
+            queue_concurrency = concurrency or queue_config.get("concurrency", consumer_config["concurrency"])
+            
+            queue = await self._declare_consumer_queue(queue_config, queue_prefetch)
             
-            # Declarar queue
-            queue = await self.channel.declare_queue(
-                queue_config["name"],
-                durable=queue_config["durable"]
+            # Configurar consumer
+            consumer_name = f"{self.service_name}_{event_type}_consumer"
+            task = asyncio.create_task(
+                self._consume_messages(queue, callback, event_type, queue_concurrency, ordering_key, dedup)
             )
+            self.consumers[consumer_name] = task
             
-            # Declarar exchange
-            exchange = await self.channel.declare_exchange(
-                queue_config["exchange"],
-                ExchangeType.TOPIC,
-                durable=True
+            logger.info(
+                f"{self.service_name} escuchando eventos '{event_type}' en queue '{queue_config['name']}' "
+                f"(prefetch={queue_prefetch}, concurrency={queue_concurrency})"
             )
+
+    async def consume_batches(
+        self,
+        event_types: List[str],
+        callback: Callable,
+        max_batch: Optional[int] = None,
+        max_wait_ms: Optional[int] = None,
+        dedup: Optional[DedupCache] = None
+    ):
+        """Consume events in batches
+        
+        The callback receives (event_type, events) with up to max_batch
+        decoded events, collected for at most max_wait_ms. It may return a
+        dict {index: error} with the events that failed; those go to retry or
+        dead letter and the rest of the batch is acked as a unit. If the
+        callback raises, the whole batch is retried. Already processed
+        messages are left out of the batch when a dedup cache is given.
+        """
+        if not self.channel:
+            await self.connect()
+        
+        consumer_config = RABBITMQ_CONFIG["consumer_config"]
+        max_batch = max(1, max_batch or consumer_config["max_batch"])
+        max_wait_ms = max_wait_ms if max_wait_ms is not None else consumer_config["max_wait_ms"]
+        
+        for event_type in event_types:
+            queue_config = self._get_queue_config_for_event(event_type)
+            # El prefetch tiene que alcanzar para llenar un lote
+            queue_prefetch = max(max_batch, queue_config.get("prefetch_count", consumer_config["prefetch_count"]))
             
-            # Bind queue al exchange
-            await queue.bind(exchange, queue_config["routing_key"])
+            queue = await self._declare_consumer_queue(queue_config, queue_prefetch)
             
-            # Configurar consumer
-            consumer_name = f"{self.service_name}_{event_type}_consumer"
+            consumer_name = f"{self.service_name}_{event_type}_batch_consumer"
             task = asyncio.create_task(
-                self._consume_messages(queue, callback, event_type)
+                self._consume_batches(queue, callback, event_type, max_batch, max_wait_ms / 1000, dedup)
             )
             self.consumers[consumer_name] = task
             
-            logger.info(f"{self.service_name} escuchando eventos '{event_type}' en queue '{queue_config['name']}'")
+            logger.info(
+                f"{self.service_name} escuchando lotes de '{event_type}' en queue '{queue_config['name']}' "
+                f"(max_batch={max_batch}, max_wait_ms={max_wait_ms})"
+            )
 
-    async def _consume_messages(self, queue, callback: Callable, event_type: str):
-        """Consume messages from a specific queue"""
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
+    async def _declare_consumer_queue(self, queue_config: Dict, prefetch_count: int):
+        """Declare a queue, its binding and retry queue on a dedicated channel"""
+        # Canal propio por queue para que el prefetch aplique por queue
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=prefetch_count)
+        
+        # Declarar queue
+        queue = await channel.declare_queue(
+            queue_config["name"],
+            durable=queue_config["durable"]
+        )
+        
+        # Bind queue al exchange (ya declarado en _setup_exchanges)
+        exchange = await channel.get_exchange(queue_config["exchange"], ensure=False)
+        await queue.bind(exchange, queue_config["routing_key"])
+        
+        # Queue de reintento: los mensajes esperan retry_delay y vuelven a la queue original
+        await channel.declare_queue(
+            self._get_retry_queue_name(queue_config["name"]),
+            durable=True,
+            arguments={
+                "x-message-ttl": self.retry_config["retry_delay"],
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_config["name"]
+            }
+        )
+        
+        # Medir la profundidad de la queue mientras haya consumers
+        self._consumer_queues.add(queue_config["name"])
+        if "queue_depth_poller" not in self.consumers:
+            self.consumers["queue_depth_poller"] = asyncio.create_task(self._poll_queue_depth())
+        return queue
+
+    async def _consume_messages(
+        self,
+        queue,
+        callback: Callable,
+        event_type: str,
+        concurrency: int = 1,
+        ordering_key: Optional[Callable[[Dict[str, Any]], Any]] = None,
+        dedup: Optional[DedupCache] = None
+    ):
+        """Consume messages from a specific queue with a bounded worker pool
+        
+        A worker takes a pool slot only after the previous message of its key
+        finished, so messages waiting on their key never block other keys. The
+        waiting workers are bounded by the prefetch of the queue.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        workers: set = set()
+        # Última tarea por clave de orden, para encadenar mensajes de la misma clave
+        key_tails: Dict[Any, asyncio.Task] = {}
+        
+        in_flight = metrics.MESSAGES_IN_FLIGHT.labels(self.service_name, queue.name)
+        
+        async def process(message: AbstractIncomingMessage, message_data: Dict[str, Any], previous: Optional[asyncio.Task]):
+            # Tipo real del evento (la queue puede estar bindeada con un patrón)
+            message_type = message_data.get("event_type", event_type)
+            if previous is not None:
+                await asyncio.wait([previous])
+            await semaphore.acquire()
+            in_flight.inc()
+            # Cada worker es una tarea propia: el contexto de traza no se mezcla entre mensajes
+            trace_context = tracing.context_from_headers(message.headers)
+            tracing.use_context(trace_context)
+            try:
+                self._observe_delivery(message, queue.name, message_type)
+                # Si no se pudo reencolar el mensaje fallido, vuelve a la queue
+                async with message.process(requeue=True):
+                    if dedup is not None and await dedup.is_duplicate(message.message_id):
+                        metrics.DUPLICATES_SKIPPED.labels(self.service_name, queue.name).inc()
+                        logger.debug(f"{self.service_name} mensaje duplicado {message.message_id} ignorado")
+                        return
+                    start = time.perf_counter()
+                    status = "cancelled"
                     try:
-                        # Decodificar mensaje
-                        message_data = json.loads(message.body.decode())
-                        
-                        logger.info(f"{self.service_name} procesando evento '{event_type}': {message_data.get('data', {})}")
+                        logger.debug(f"{self.service_name} procesando evento '{message_type}': {message_data.get('data', {})}")
                         
                         # Llamar callback
-                        await callback(event_type, message_data)
+                        await callback(message_type, message_data)
+                        status = "ok"
+                        if dedup is not None:
+                            await dedup.remember(message.message_id)
                         
                     except Exception as e:
+                        status = "error"
                         logger.error(f"Error procesando mensaje en {self.service_name}: {e}")
-                        
+                        await self._retry_or_dead_letter(message, queue.name, e)
+                    finally:
+                        elapsed = time.perf_counter() - start
+                        metrics.CONSUME_DURATION.labels(self.service_name, message_type, status).observe(elapsed)
+                        self._observe_trace(trace_context, message_type, status, elapsed)
+            finally:
+                in_flight.dec()
+                semaphore.release()
+        
+        try:
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    try:
+                        # Decodificar mensaje
+                        message_data = decode_event(message.body, message.content_type)
+                    except Exception as e:
+                        logger.error(f"Mensaje inválido en {self.service_name}: {e}")
+                        async with message.process(requeue=True):
+                            await self._dead_letter(message, queue.name, e)
+                        continue
+                    
+                    key = None
+                    if ordering_key:
+                        try:
+                            key = ordering_key(message_data)
+                            hash(key)
+                        except Exception as e:
+                            # Sin clave el mensaje se procesa igual, sólo que sin orden garantizado
+                            logger.warning(f"ordering_key falló en {self.service_name} ({queue.name}), sin orden: {e}")
+                            key = None
+                    previous = key_tails.get(key) if key is not None else None
+                    
+                    worker = asyncio.create_task(process(message, message_data, previous))
+                    workers.add(worker)
+                    worker.add_done_callback(workers.discard)
+                    
+                    if key is not None:
+                        key_tails[key] = worker
+                        worker.add_done_callback(
+                            lambda task, key=key: key_tails.pop(key, None) if key_tails.get(key) is task else None
+                        )
+        finally:
+            # Los mensajes sin ack vuelven a la queue al cerrar el canal
+            for worker in list(workers):
+                worker.cancel()
+
+    async def _consume_batches(
+        self,
+        queue,
+        callback: Callable,
+        event_type: str,
+        max_batch: int,
+        max_wait: float,
+        dedup: Optional[DedupCache] = None
+    ):
+        """Collect messages from a queue into batches and process them one batch at a time"""
+        buffer: asyncio.Queue = asyncio.Queue()
+        consumer_tag = await queue.consume(buffer.put)
+        loop = asyncio.get_running_loop()
+        
+        try:
+            while True:
+                batch = [await buffer.get()]
+                deadline = loop.time() + max_wait
+                while len(batch) < max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(buffer.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                
+                await self._process_batch(batch, queue.name, callback, event_type, dedup)
+        finally:
+            await queue.cancel(consumer_tag)
+
+    async def _process_batch(
+        self,
+        batch: List[AbstractIncomingMessage],
+        queue_name: str,
+        callback: Callable,
+        event_type: str,
+        dedup: Optional[DedupCache] = None
+    ):
+        """Run the batch callback and ack, retry or dead letter its messages"""
+        messages = []
+        events = []
+        contexts: List[tracing.TraceContext] = []
+        # Ids ya vistos en este mismo lote (el cache se actualiza al terminar el lote)
+        batch_ids = set()
+        in_flight = metrics.MESSAGES_IN_FLIGHT.labels(self.service_name, queue_name)
+        in_flight.inc(len(batch))
+        try:
+            for message in batch:
+                self._observe_delivery(message, queue_name, (message.headers or {}).get("event_type", event_type))
+                if dedup is not None and message.message_id and (
+                    message.message_id in batch_ids or await dedup.is_duplicate(message.message_id)
+                ):
+                    metrics.DUPLICATES_SKIPPED.labels(self.service_name, queue_name).inc()
+                    continue
+                batch_ids.add(message.message_id)
+                try:
+                    events.append(decode_event(message.body, message.content_type))
+                    messages.append(message)
+                    contexts.append(tracing.context_from_headers(message.headers))
+                except Exception as e:
+                    logger.error(f"Mensaje inválido en {self.service_name}: {e}")
+                    await self._dead_letter(message, queue_name, e)
+            
+            failures: Dict[int, Any] = {}
+            if events:
+                # Un lote mezcla trazas: lo que publique el callback continúa la del primer evento
+                token = tracing.use_context(contexts[0])
+                start = time.perf_counter()
+                try:
+                    failures = await callback(event_type, events) or {}
+                except Exception as e:
+                    logger.error(f"Error procesando lote de {len(events)} mensajes en {self.service_name}: {e}")
+                    failures = {index: e for index in range(len(events))}
+                finally:
+                    tracing.reset_context(token)
+                elapsed = time.perf_counter() - start
+                metrics.CONSUME_DURATION.labels(
+                    self.service_name, event_type, "error" if failures else "ok"
+                ).observe(elapsed)
+                for index, (event, context) in enumerate(zip(events, contexts)):
+                    self._observe_trace(
+                        context, event.get("event_type", event_type), "error" if index in failures else "ok", elapsed
+                    )
+            
+            for index, error in failures.items():
+                if 0 <= index < len(messages):
+                    await self._retry_or_dead_letter(messages[index], queue_name, error)
+            
+            if dedup is not None:
+                for index, message in enumerate(messages):
+                    if index not in failures:
+                        await dedup.remember(message.message_id)
+            
+            # El canal es exclusivo de esta queue y los lotes son secuenciales: un ack cubre todo el lote
+            await batch[-1].ack(multiple=True)
+            
+            if failures:
+                logger.warning(f"{self.service_name} lote de '{event_type}': {len(failures)}/{len(batch)} mensajes fallaron")
+        except Exception as e:
+            logger.error(f"Error confirmando lote en {self.service_name}, se devuelve a la queue: {e}")
+            await batch[-1].nack(multiple=True, requeue=True)
+        finally:
+            in_flight.dec(len(batch))
+
+    def _observe_delivery(self, message: AbstractIncomingMessage, queue_name: str, event_type: str):
+        """Record redeliveries and the publish-to-consume lag of a message"""
+        headers = message.headers or {}
+        if message.redelivered or headers.get("x-retry-count"):
+            metrics.REDELIVERIES.labels(self.service_name, queue_name).inc()
+        published_at = headers.get("published_at")
+        if isinstance(published_at, (int, float)):
+            metrics.CONSUME_LAG.labels(self.service_name, event_type).observe(max(0.0, time.time() - published_at))
+
+    def _observe_trace(self, trace_context: "tracing.TraceContext", event_type: str, status: str, elapsed: float):
+        """Record end-to-end latency of a handled event and export its span"""
+        end = time.time()
+        metrics.EVENT_END_TO_END_LATENCY.labels(
+            self.service_name, event_type, str(trace_context.hop)
+        ).observe(max(0.0, end - trace_context.origin_ts))
+        tracing.span_exporter.export(
+            f"consume {event_type}", self.service_name, trace_context, end - elapsed, end,
+            {"event_type": event_type, "status": status, "hop": trace_context.hop,
+             "end_to_end_seconds": end - trace_context.origin_ts}
+        )
+
+    async def _poll_queue_depth(self):
+        """Periodically read depth and consumer count of the consumed queues from the broker"""
+        interval = RABBITMQ_CONFIG["metrics_config"]["queue_depth_interval"]
+        while True:
+            await asyncio.sleep(interval)
+            for queue_name in list(self._consumer_queues):
+                try:
+                    # En el canal principal: un error no corta los canales de los consumers
+                    queue = await self.channel.declare_queue(queue_name, passive=True)
+                    metrics.QUEUE_DEPTH.labels(self.service_name, queue_name).set(queue.declaration_result.message_count)
+                    metrics.QUEUE_CONSUMERS.labels(self.service_name, queue_name).set(queue.declaration_result.consumer_count)
+                except Exception as e:
+                    logger.debug(f"No se pudo leer la profundidad de '{queue_name}': {e}")
+
+    async def _retry_or_dead_letter(self, message: AbstractIncomingMessage, queue_name: str, error: Exception):
+        """Send a failed message to its retry queue, or to the DLX once retries are exhausted"""
+        retry_count = int((message.headers or {}).get("x-retry-count", 0))
+        
+        if retry_count >= self.retry_config["max_retries"]:
+            await self._dead_letter(message, queue_name, error)
+            return
+        
+        metrics.RETRIES.labels(self.service_name, queue_name).inc()
+        
+        exchange = await self._get_publisher_exchange("")
+        await exchange.publish(
+            self._copy_message(message, {"x-retry-count": retry_count + 1}),
+            routing_key=self._get_retry_queue_name(queue_name)
+        )
+        logger.warning(
+            f"{self.service_name} reintento {retry_count + 1}/{self.retry_config['max_retries']} "
+            f"para mensaje de '{queue_name}'"
+        )
+
+    async def _dead_letter(self, message: AbstractIncomingMessage, queue_name: str, error: Exception):
+        """Publish a message to the dead letter exchange"""
+        exchange = await self._get_publisher_exchange(self.retry_config["dead_letter_exchange"])
+        await exchange.publish(
+            self._copy_message(message, {
+                "x-original-queue": queue_name,
+                "x-error": str(error)[:500],
+                "x-dead-lettered-at": datetime.now().isoformat()
+            }),
+            routing_key=message.routing_key or queue_name
+        )
+        metrics.DEAD_LETTERS.labels(self.service_name, queue_name).inc()
+        logger.error(f"{self.service_name} envió mensaje de '{queue_name}' a la dead letter queue: {error}")
+
+    @staticmethod
+    def _copy_message(message: AbstractIncomingMessage, headers: Dict[str, Any], merge: bool = True) -> Message:
+        """Copy an incoming message with extra (or replaced) headers so it can be republished"""
+        if merge:
+            headers = {**(message.headers or {}), **headers}
+        return Message(
+            message.body,
+            delivery_mode=DeliveryMode.PERSISTENT,
+            content_type=message.content_type,
+            message_id=message.message_id,
+            correlation_id=message.correlation_id,
+            headers=headers
+        )
+
+    @staticmethod
+    def _get_retry_queue_name(queue_name: str) -> str:
+        """Name of the delayed retry queue for a queue"""
+        return f"{queue_name}.retry"
+
+    async def inspect_dead_letters(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Peek at up to limit messages in the dead letter queue without removing them"""
+        if not self.channel:
+            await self.connect()
+        
+        queue = await self.channel.declare_queue(self.retry_config["dead_letter_queue"], durable=True)
+        held = []
+        try:
+            while len(held) < limit:
+                message = await queue.get(fail=False)
+                if message is None:
+                    break
+                held.append(message)
+            
+            return [
+                {
+                    "routing_key": message.routing_key,
+                    "original_queue": (message.headers or {}).get("x-original-queue"),
+                    "retry_count": (message.headers or {}).get("x-retry-count", 0),
+                    "error": (message.headers or {}).get("x-error"),
+                    "dead_lettered_at": (message.headers or {}).get("x-dead-lettered-at"),
+                    "event": self._decode_for_inspection(message)
+                }
+                for message in held
+            ]
+        finally:
+            # Devolver los mensajes a la DLQ
+            for message in held:
+                await message.nack(requeue=True)
+
+    @staticmethod
+    def _decode_for_inspection(message: AbstractIncomingMessage) -> Any:
+        """Decode a dead lettered body, falling back to text when it is not a valid event"""
+        try:
+            return decode_event(message.body, message.content_type)
+        except Exception:
+            return message.body.decode(errors="replace")
+
+    async def replay_dead_letters(self, limit: Optional[int] = None, original_queue: Optional[str] = None) -> int:
+        """Move dead lettered messages back to their original queue, returns how many were replayed"""
+        if not self.channel:
+            await self.connect()
+        
+        queue = await self.channel.declare_queue(self.retry_config["dead_letter_queue"], durable=True)
+        exchange = await self._get_publisher_exchange("")
+        skipped = []
+        replayed = 0
+        try:
+            while limit is None or replayed < limit:
+                message = await queue.get(fail=False)
+                if message is None:
+                    break
+                
+                headers = dict(message.headers or {})
+                target_queue = headers.pop("x-original-queue", None)
+                if not target_queue or (original_queue and target_queue != original_queue):
+                    skipped.append(message)
+                    continue
+                
+                for header in ("x-retry-count", "x-error", "x-dead-lettered-at"):
+                    headers.pop(header, None)
+                await exchange.publish(self._copy_message(message, headers, merge=False), routing_key=target_queue)
+                await message.ack()
+                replayed += 1
+        finally:
+            for message in skipped:
+                await message.nack(requeue=True)
+        
+        logger.info(f"{self.service_name} reprocesó {replayed} mensajes de la dead letter queue")
+        return replayed
 
     def _get_exchange_for_event(self, event_type: str) -> str:
         """Get the correct exchange for an event type"""
@@ -179,51 +797,151 @@ class RabbitMQClient:
             return "user.events"  # Default
 
     def _get_queue_config_for_event(self, event_type: str) -> Dict:
-        """Get queue configuration for an event type"""
+        """Get queue configuration for an event type (or a topic pattern such as 'friendship.*')
+        
+        Queue names are derived from (service_name, event_type): every service
+        gets its own copy of each event, and replicas of the same service share
+        the queue and split the work between them.
+        """
         queue_key = event_type.replace(".", "_")
         if queue_key in RABBITMQ_CONFIG["queues"]:
-            return RABBITMQ_CONFIG["queues"][queue_key]
+            queue_config = dict(RABBITMQ_CONFIG["queues"][queue_key])
         else:
             # Queue por defecto
-            return {
-                "name": f"{event_type.replace('.', '_')}.queue",
+            queue_config = {
+                "name": f"{event_type.replace('*', 'any').replace('#', 'all')}.queue",
                 "exchange": self._get_exchange_for_event(event_type),
                 "routing_key": event_type,
                 "durable": True
             }
+        queue_config["name"] = f"{self.service_name}.{queue_config['name']}"
+        return queue_config
 
 # Utility functions for specific events
 class EventPublisher:
     """Helper class to publish common events"""
     
-    def __init__(self, client: RabbitMQClient):
+    def __init__(self, client: RabbitMQClient, buffered: Optional[bool] = None):
         self.client = client
+        
+        # Modo fire-and-forget: los eventos se publican en background por lotes
+        buffer_config = RABBITMQ_CONFIG["publish_buffer"]
+        if buffered is None:
+            buffered = buffer_config["enabled"]
+        self.buffer: Optional[PublishBuffer] = None
+        if buffered:
+            self.buffer = PublishBuffer(
+                client,
+                max_size=buffer_config["max_size"],
+                batch_size=buffer_config["batch_size"],
+                flush_interval_ms=buffer_config["flush_interval_ms"],
+                overflow_policy=buffer_config["overflow_policy"],
+                spill_path=buffer_config["spill_path"].format(service=client.service_name) or None
+            )
+        
+        # Coalescing por tipo de evento
+        self.coalescers: Dict[str, EventCoalescer] = {}
+    
+    def coalesce(
+        self,
+        event_type: str,
+        window_ms: int,
+        key: Callable[[Dict[str, Any]], Any],
+        mode: str = COALESCE_DROP,
+        merge: Optional[Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]] = None
+    ) -> EventCoalescer:
+        """Coalesce repeated events of a type with the same key inside window_ms
+        
+        mode "drop" publishes the first event of each window and drops the
+        rest; mode "merge" publishes one event per window at its end, combining
+        them with merge(previous, current) (last one wins by default). Events
+        whose key is None are never coalesced.
+        """
+        coalescer = EventCoalescer(
+            self.client.service_name, event_type, window_ms, key, self._publish_now, mode=mode, merge=merge
+        )
+        self.coalescers[event_type] = coalescer
+        return coalescer
     
     async def publish_event(self, event_type: str, data: Dict[str, Any], routing_key: Optional[str] = None):
         """Publish generic event"""
-        await self.client.publish_event(event_type, data, routing_key)
+        # La traza y el message_id se fijan ahora: el flusher y el coalescing corren fuera
+        # del request, y los reintentos del buffer deben publicar el mismo id
+        trace_headers = tracing.outgoing_headers()
+        coalescer = self.coalescers.get(event_type)
+        if coalescer and not await coalescer.offer(data, routing_key, trace_headers):
+            return
+        await self._publish_now(event_type, data, routing_key, trace_headers, uuid.uuid4().hex)
+    
+    async def publish_many(self, events: List[Tuple]):
+        """Publish a list of (event_type, data[, routing_key[, headers[, message_id]]]) events in one batch"""
+        trace_headers = tracing.outgoing_headers()
+        pending = []
+        for event in events:
+            event_type, data = event[0], event[1]
+            routing_key = event[2] if len(event) > 2 else None
+            headers = event[3] if len(event) > 3 else trace_headers
+            message_id = (event[4] if len(event) > 4 else None) or uuid.uuid4().hex
+            coalescer = self.coalescers.get(event_type)
+            if coalescer and not await coalescer.offer(data, routing_key, headers):
+                continue
+            pending.append((event_type, data, routing_key, headers, message_id))
+        
+        if self.buffer:
+            for event in pending:
+                await self.buffer.enqueue(*event)
+        else:
+            await self.client.publish_many(pending)
+    
+    async def _publish_now(
+        self,
+        event_type: str,
+        data: Dict[str, Any],
+        routing_key: Optional[str],
+        trace_headers: Optional[Dict[str, Any]],
+        message_id: Optional[str] = None
+    ):
+        """Publish (or buffer) a single event that passed coalescing
+        
+        Events emitted by a coalescer at the end of a window get their id here.
+        """
+        message_id = message_id or uuid.uuid4().hex
+        if self.buffer:
+            await self.buffer.enqueue(event_type, data, routing_key, trace_headers, message_id)
+        else:
+            await self.client.publish_event(event_type, data, routing_key, trace_headers, message_id)
+    
+    async def close(self):
+        """Flush coalesced and buffered events (call before disconnecting the client)"""
+        for coalescer in self.coalescers.values():
+            await coalescer.close()
+        if self.buffer:
+            await self.buffer.close()
     
     async def publish_user_registered(self, user_data: Dict[str, Any]):
         """Publicar evento de usuario registrado"""
-        await self.client.publish_event(SystemEvents.USER_REGISTERED, user_data)
+        await self.publish_event(SystemEvents.USER_REGISTERED, user_data)
     
     async def publish_user_login(self, user_data: Dict[str, Any]):
         """Publicar evento de usuario logueado"""
-        await self.client.publish_event(SystemEvents.USER_LOGIN, user_data)
+        await self.publish_event(SystemEvents.USER_LOGIN, user_data)
     
     async def publish_content_created(self, content_data: Dict[str, Any]):
         """Publicar evento de contenido creado"""
-        await self.client.publish_event(SystemEvents.CONTENT_CREATED, content_data)
+        await self.publish_event(SystemEvents.CONTENT_CREATED, content_data)
     
     async def publish_message_sent(self, message_data: Dict[str, Any]):
         """Publicar evento de mensaje enviado"""
-        await self.client.publish_event(SystemEvents.MESSAGE_SENT, message_data)
+        await self.publish_event(SystemEvents.MESSAGE_SENT, message_data)
     
     async def publish_moderation_review(self, review_data: Dict[str, Any]):
         """Publish moderation review event"""
-        await self.client.publish_event(SystemEvents.MODERATION_REVIEW, review_data)
+        await self.publish_event(SystemEvents.MODERATION_REVIEW, review_data)
 
 # Factory function to create clients
 def create_rabbitmq_client(service_name: str) -> RabbitMQClient:
-    """Create RabbitMQ client for a specific service"""
+    """Create RabbitMQ client for a specific service (EVENT_BROKER=memory uses the in-process broker)"""
+    if RABBITMQ_CONFIG["broker"] == "memory":
+        from .memory_broker import InMemoryRabbitMQClient
+        return InMemoryRabbitMQClient(service_name)
     return RabbitMQClient(service_name)
@@ -0,0 +1,114 @@
+"""
+Métricas Prometheus del cliente RabbitMQ compartido
+Se registran en el registry por defecto de prometheus_client, el mismo que expone
+Instrumentator en /metrics de cada servicio
+"""
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    Counter = Gauge = Histogram = None
+
+
+class _NoopMetric:
+    """Stand-in used when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def dec(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+
+def _metric(metric_class, name: str, documentation: str, labelnames, **kwargs):
+    if metric_class is None:
+        return _NoopMetric()
+    return metric_class(name, documentation, labelnames, **kwargs)
+
+
+# Buckets pensados para latencias de broker (ms a segundos)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PUBLISH_LATENCY = _metric(
+    Histogram, "rabbitmq_publish_duration_seconds",
+    "Time until the broker confirms a published event",
+    ["service", "event_type"], buckets=LATENCY_BUCKETS
+)
+PUBLISH_FAILURES = _metric(
+    Counter, "rabbitmq_publish_failures_total",
+    "Events that could not be published",
+    ["service", "event_type"]
+)
+CONSUME_DURATION = _metric(
+    Histogram, "rabbitmq_consume_duration_seconds",
+    "Time spent in consumer handlers",
+    ["service", "event_type", "status"], buckets=LATENCY_BUCKETS
+)
+CONSUME_LAG = _metric(
+    Histogram, "rabbitmq_consume_lag_seconds",
+    "Time between publishing an event and a consumer starting to handle it (per-hop latency)",
+    ["service", "event_type"], buckets=LATENCY_BUCKETS
+)
+EVENT_END_TO_END_LATENCY = _metric(
+    Histogram, "event_end_to_end_latency_seconds",
+    "Time from the originating request (trace origin) until a consumer finished handling the event",
+    ["service", "event_type", "hop"], buckets=LATENCY_BUCKETS + (30.0, 60.0)
+)
+MESSAGES_IN_FLIGHT = _metric(
+    Gauge, "rabbitmq_messages_in_flight",
+    "Messages delivered to a consumer and not yet acked",
+    ["service", "queue"]
+)
+REDELIVERIES = _metric(
+    Counter, "rabbitmq_redeliveries_total",
+    "Messages received again after a broker redelivery or a retry",
+    ["service", "queue"]
+)
+DUPLICATES_SKIPPED = _metric(
+    Counter, "rabbitmq_duplicates_skipped_total",
+    "Messages acked without processing because their message_id was already handled",
+    ["service", "queue"]
+)
+RETRIES = _metric(
+    Counter, "rabbitmq_retries_total",
+    "Failed messages sent to their retry queue",
+    ["service", "queue"]
+)
+DEAD_LETTERS = _metric(
+    Counter, "rabbitmq_dead_letters_total",
+    "Messages sent to the dead letter queue",
+    ["service", "queue"]
+)
+QUEUE_DEPTH = _metric(
+    Gauge, "rabbitmq_queue_depth",
+    "Messages ready in a consumed queue, as reported by the broker",
+    ["service", "queue"]
+)
+QUEUE_CONSUMERS = _metric(
+    Gauge, "rabbitmq_queue_consumers",
+    "Consumers attached to a consumed queue, as reported by the broker",
+    ["service", "queue"]
+)
+EVENTS_COALESCED = _metric(
+    Counter, "rabbitmq_events_coalesced_total",
+    "Events dropped or merged by publisher-side coalescing",
+    ["service", "event_type"]
+)
+PUBLISH_BUFFER_SIZE = _metric(
+    Gauge, "rabbitmq_publish_buffer_size",
+    "Events waiting in the background publish buffer",
+    ["service"]
+)
+PUBLISH_BUFFER_OVERFLOW = _metric(
+    Counter, "rabbitmq_publish_buffer_overflow_total",
+    "Events dropped or spilled to disk because the publish buffer was full",
+    ["service", "policy"]
+)
@@ -0,0 +1,143 @@
+"""
+Propagación de contexto de traza entre servicios
+Cada request HTTP (o evento consumido) define un trace_id y el timestamp de origen;
+los eventos publicados los llevan en sus headers para medir la latencia por salto
+y de punta a punta (ej. upload -> moderado -> notificado por websocket)
+"""
+import os
+import time
+import uuid
+import logging
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from .event_codec import dumps_json
+
+logger = logging.getLogger(__name__)
+
+# Headers AMQP / HTTP
+TRACE_ID_HEADER = "x-trace-id"
+PARENT_SPAN_HEADER = "x-parent-span-id"
+ORIGIN_TS_HEADER = "x-origin-ts"
+HOP_HEADER = "x-hop"
+
+
+class TraceContext:
+    """Trace identifiers carried by the current request or event handler"""
+
+    __slots__ = ("trace_id", "span_id", "parent_span_id", "origin_ts", "hop")
+
+    def __init__(self, trace_id: str, origin_ts: float, parent_span_id: Optional[str] = None, hop: int = 0):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.origin_ts = origin_ts
+        self.hop = hop
+
+
+_current: ContextVar[Optional[TraceContext]] = ContextVar("trace_context", default=None)
+
+
+def context_from_headers(headers: Optional[Dict[str, Any]]) -> TraceContext:
+    """Build the context of a consumed event from its headers (old producers start a new trace)"""
+    headers = headers or {}
+    trace_id = headers.get(TRACE_ID_HEADER)
+    if not trace_id:
+        return TraceContext(uuid.uuid4().hex, headers.get("published_at") or time.time())
+    return TraceContext(
+        str(trace_id),
+        float(headers.get(ORIGIN_TS_HEADER) or time.time()),
+        parent_span_id=headers.get(PARENT_SPAN_HEADER),
+        hop=int(headers.get(HOP_HEADER, 0))
+    )
+
+
+def use_context(context: TraceContext):
+    """Set the current context, returns a token for reset_context"""
+    return _current.set(context)
+
+
+def reset_context(token):
+    _current.reset(token)
+
+
+def outgoing_headers() -> Dict[str, Any]:
+    """Headers for an event published from the current context"""
+    context = _current.get()
+    if context is None:
+        # Evento sin request de origen: empieza su propia traza
+        return {TRACE_ID_HEADER: uuid.uuid4().hex, ORIGIN_TS_HEADER: time.time(), HOP_HEADER: 1}
+    return {
+        TRACE_ID_HEADER: context.trace_id,
+        PARENT_SPAN_HEADER: context.span_id,
+        ORIGIN_TS_HEADER: context.origin_ts,
+        HOP_HEADER: context.hop + 1
+    }
+
+
+class SpanExporter:
+    """Writes finished spans as JSON lines (OTLP-like field names) to TRACE_EXPORT_PATH"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._file = None
+
+    def export(self, name: str, service: str, context: TraceContext, start: float, end: float, attributes: Dict[str, Any]):
+        if not self.path:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(dumps_json({
+                "traceId": context.trace_id,
+                "spanId": context.span_id,
+                "parentSpanId": context.parent_span_id,
+                "name": name,
+                "service.name": service,
+                "startTimeUnixNano": int(start * 1e9),
+                "endTimeUnixNano": int(end * 1e9),
+                "attributes": attributes
+            }) + "\n")
+        except OSError as e:
+            logger.error(f"No se pudo exportar el span a {self.path}: {e}")
+            self.path = None
+
+
+span_exporter = SpanExporter(os.getenv("TRACE_EXPORT_PATH"))
+
+
+class TraceContextMiddleware:
+    """ASGI middleware that starts (or continues, via X-Trace-Id) a trace for each HTTP request"""
+
+    def __init__(self, app, service_name: str):
+        self.app = app
+        self.service_name = service_name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-trace-id":
+                trace_id = value.decode("latin-1")
+                break
+
+        start = time.time()
+        context = TraceContext(trace_id or uuid.uuid4().hex, start)
+        token = _current.set(context)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-trace-id", context.trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            _current.reset(token)
+            span_exporter.export(
+                f"{scope.get('method', '')} {scope.get('path', '')}", self.service_name, context, start, time.time(), {}
+            )
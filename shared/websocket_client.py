@@ -6,84 +6,202 @@ Permite a otros microservicios comunicarse con el WebSocket service
 import asyncio
 import json
 import logging
-from typing import Dict, Any, Optional
+import os
+from collections import deque
+from typing import Dict, Any, List, Optional
 import websockets
 from websockets.exceptions import ConnectionClosed, WebSocketException
 
 logger = logging.getLogger(__name__)
 
 class WebSocketClient:
-    """Cliente para comunicarse con el WebSocket service"""
+    """Cliente para comunicarse con el WebSocket service
     
-    def __init__(self, websocket_service_url: str = "ws://websocket-service:8000"):
+    Mantiene un pool de conexiones que se reconectan solas (backoff exponencial) y
+    agrupa los mensajes en frames service_batch: send_* sólo encola y devuelve.
+    El orden entre mensajes sólo se garantiza con pool_size=1
+    """
+    
+    def __init__(
+        self,
+        websocket_service_url: str = "ws://websocket-service:8000",
+        pool_size: int = 2,
+        batch_size: int = 100,
+        flush_interval_ms: int = 10,
+        max_pending: int = 10000,
+        service_token: Optional[str] = None,
+        reconnect_min_delay: float = 0.5,
+        reconnect_max_delay: float = 30.0
+    ):
         self.websocket_service_url = websocket_service_url
-        self.connection = None
+        self.pool_size = max(1, pool_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self.service_token = service_token or os.getenv("WS_SERVICE_TOKEN")
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
         self.service_id = None
+        
+        self.connections: List[Optional[Any]] = [None] * self.pool_size
+        self._queue: Optional[asyncio.Queue] = None
+        # Lotes que no se pudieron enviar, se reintentan antes que los nuevos
+        self._retry: deque = deque()
+        self._tasks: List[asyncio.Task] = []
+        self._connected = asyncio.Event()
+    
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks)
+    
+    @property
+    def is_connected(self) -> bool:
+        return any(connection is not None for connection in self.connections)
+    
+    @property
+    def pending(self) -> int:
+        """Messages waiting to be sent"""
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + sum(len(batch) for batch in self._retry)
     
-    async def connect(self, service_id: str):
-        """Conectar al WebSocket service como microservicio"""
+    async def connect(self, service_id: str, timeout: float = 5.0):
+        """Conectar al WebSocket service como microservicio
+        
+        Devuelve si alguna conexión del pool quedó abierta dentro del timeout; si no,
+        el pool sigue reintentando en segundo plano y los mensajes quedan encolados
+        """
+        if self.started:
+            return self.is_connected
+        self.service_id = service_id
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._connected = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run_connection(index)) for index in range(self.pool_size)]
         try:
-            self.service_id = service_id
-            self.connection = await websockets.connect(
-                f"{self.websocket_service_url}/ws/{service_id}"
-            )
+            await asyncio.wait_for(self._connected.wait(), timeout)
             logger.info(f"Microservicio {service_id} conectado al WebSocket service")
-            return True
-        except Exception as e:
-            logger.error(f"Error conectando al WebSocket service: {e}")
-            return False
+        except asyncio.TimeoutError:
+            logger.error(f"Error conectando al WebSocket service: sin conexión después de {timeout}s, reintentando")
+        return self.is_connected
     
-    async def disconnect(self):
-        """Desconectar del WebSocket service"""
-        if self.connection:
-            await self.connection.close()
-            self.connection = None
-            logger.info(f"Microservicio {self.service_id} desconectado del WebSocket service")
+    async def disconnect(self, flush_timeout: float = 2.0):
+        """Desconectar del WebSocket service (intenta enviar lo pendiente antes)"""
+        if not self.started:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + flush_timeout
+        while self.pending and self.is_connected and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        if self.pending:
+            logger.warning(f"{self.pending} mensajes descartados al desconectar {self.service_id}")
+        
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._retry.clear()
+        logger.info(f"Microservicio {self.service_id} desconectado del WebSocket service")
     
     async def send_message_to_user(self, user_id: str, message_type: str, data: Dict[str, Any]):
         """Send message to a specific user"""
-        if not self.connection:
-            logger.error("No connection to WebSocket service")
-            return False
-        
-        message = {
-            "type": "service_message",
-            "target_user": user_id,
-            "message_type": message_type,
-            "data": data,
-            "service_id": self.service_id
-        }
-        
-        try:
-            await self.connection.send(json.dumps(message))
-            logger.info(f"Mensaje enviado a usuario {user_id} desde {self.service_id}")
-            return True
-        except Exception as e:
-            logger.error(f"Error enviando mensaje a usuario {user_id}: {e}")
-            return False
+        return self._enqueue({"target_user": user_id, "message_type": message_type, "data": data})
     
     async def send_message_to_room(self, room_id: str, message_type: str, data: Dict[str, Any]):
         """Send message to a specific room"""
-        if not self.connection:
+        return self._enqueue({"room_id": room_id, "message_type": message_type, "data": data})
+    
+    def _enqueue(self, item: Dict[str, Any]) -> bool:
+        if not self.started:
             logger.error("No connection to WebSocket service")
             return False
-        
-        message = {
-            "type": "service_room_message",
-            "room_id": room_id,
-            "message_type": message_type,
-            "data": data,
-            "service_id": self.service_id
-        }
-        
         try:
-            await self.connection.send(json.dumps(message))
-            logger.info(f"Mensaje enviado a sala {room_id} desde {self.service_id}")
+            self._queue.put_nowait(item)
             return True
-        except Exception as e:
-            logger.error(f"Error enviando mensaje a sala {room_id}: {e}")
+        except asyncio.QueueFull:
+            logger.error(f"Cola de envío al WebSocket service llena ({self.max_pending}), mensaje descartado")
             return False
     
+    async def _run_connection(self, index: int):
+        """Keep one pooled connection open, reconnecting with exponential backoff"""
+        delay = self.reconnect_min_delay
+        url = f"{self.websocket_service_url}/ws/{self.service_id}"
+        # Con el token en el handshake la conexión tiene los límites de entrada de servicio
+        # (WS_SERVICE_INBOUND_RATE); sin él se limita como un navegador y un envío sostenido
+        # de lotes cada flush_interval_ms acabaría cerrado con 1008
+        headers = {"X-Service-Token": self.service_token} if self.service_token else None
+        while True:
+            try:
+                async with websockets.connect(url, extra_headers=headers) as connection:
+                    self.connections[index] = connection
+                    self._connected.set()
+                    delay = self.reconnect_min_delay
+                    await self._serve(connection)
+            except asyncio.CancelledError:
+                raise
+            except (ConnectionClosed, WebSocketException, OSError) as e:
+                logger.warning(f"Conexión {index} al WebSocket service perdida: {e}")
+            except Exception as e:
+                logger.error(f"Error en la conexión {index} al WebSocket service: {e}")
+            finally:
+                self.connections[index] = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+    
+    async def _serve(self, connection):
+        """Send batches and answer heartbeats until the connection closes"""
+        lock = asyncio.Lock()
+        sender = asyncio.create_task(self._send_loop(connection, lock))
+        reader = asyncio.create_task(self._read_loop(connection, lock))
+        try:
+            done, _ = await asyncio.wait({sender, reader}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in (sender, reader):
+                task.cancel()
+            await asyncio.gather(sender, reader, return_exceptions=True)
+    
+    async def _read_loop(self, connection, lock: asyncio.Lock):
+        # El servidor cierra las conexiones que no responden a sus pings
+        async for raw in connection:
+            try:
+                frame = json.loads(raw)
+            except ValueError:
+                continue
+            if isinstance(frame, dict) and frame.get("type") == "ping":
+                async with lock:
+                    await connection.send(json.dumps({"type": "pong"}))
+    
+    async def _send_loop(self, connection, lock: asyncio.Lock):
+        while True:
+            batch: List[Dict[str, Any]] = []
+            try:
+                if self._retry:
+                    batch = self._retry.popleft()
+                else:
+                    batch.append(await self._queue.get())
+                    if self._queue.qsize() < self.batch_size - 1 and self.flush_interval > 0:
+                        await asyncio.sleep(self.flush_interval)
+                    while len(batch) < self.batch_size and not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                async with lock:
+                    await connection.send(self._encode_batch(batch))
+                logger.debug(f"{len(batch)} mensajes enviados desde {self.service_id}")
+            except BaseException:
+                if batch:
+                    self._retry.appendleft(batch)
+                raise
+    
+    def _encode_batch(self, batch: List[Dict[str, Any]]) -> str:
+        frame = {
+            "type": "service_batch",
+            "messages": batch,
+            "service_id": self.service_id
+        }
+        if self.service_token:
+            frame["token"] = self.service_token
+        return json.dumps(frame, default=str)
+    
     async def send_notification(self, user_id: str, title: str, message: str, notification_type: str = "info"):
         """Send notification to a user"""
         notification_data = {
@@ -130,13 +248,19 @@ class WebSocketClient:
 class WebSocketServiceIntegration:
     """Class to integrate WebSocket in existing microservices"""
     
-    def __init__(self, service_name: str, websocket_service_url: str = "ws://websocket-service:8000"):
+    def __init__(
+        self,
+        service_name: str,
+        websocket_service_url: str = "ws://websocket-service:8000",
+        service_token: Optional[str] = None
+    ):
         self.service_name = service_name
-        self.websocket_client = WebSocketClient(websocket_service_url)
+        # Without a token (argument or WS_SERVICE_TOKEN) the websocket-service rejects every push
+        self.websocket_client = WebSocketClient(websocket_service_url, service_token=service_token)
         self.is_connected = False
     
     async def start(self):
-        """Start connection to WebSocket service"""
+        """Start connection to WebSocket service (keeps reconnecting in the background)"""
         self.is_connected = await self.websocket_client.connect(self.service_name)
         return self.is_connected
     
@@ -147,12 +271,12 @@ class WebSocketServiceIntegration:
     
     async def notify_user(self, user_id: str, title: str, message: str, notification_type: str = "info"):
         """Send notification to user"""
-        if self.is_connected:
+        if self.websocket_client.started:
             return await self.websocket_client.send_notification(user_id, title, message, notification_type)
         return False
     
     async def notify_room(self, room_id: str, message_type: str, data: Dict[str, Any]):
         """Enviar mensaje a sala"""
-        if self.is_connected:
+        if self.websocket_client.started:
             return await self.websocket_client.send_message_to_room(room_id, message_type, data)
         return False